@@ -12,6 +12,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import os
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import six
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    hook_name,
+    log,
+    DEBUG,
+    INFO,
+)
+
+# Hooks in which every audit is run regardless of recorded fingerprints.
+FULL_AUDIT_HOOKS = ('install', 'config-changed', 'upgrade-charm')
+# Default maximum age, in seconds, of the last full audit pass.
+FULL_AUDIT_INTERVAL = 3600
+
+# Default number of threads used to run non-conflicting audits concurrently.
+AUDIT_THREADS = 4
+
+AUDIT_FINGERPRINTS_KEY = 'hardening-audit-fingerprints'
+AUDIT_LAST_FULL_KEY = 'hardening-audit-last-full'
+
+# State of the audit pass in progress, if any.
+_audit_pass = {}
+
 
 class BaseAudit(object):  # NO-QA
     """Base class for hardening checks.
@@ -19,11 +51,40 @@ class BaseAudit(object):  # NO-QA
     The lifecycle of a hardening check is to first check to see if the system
     is in compliance for the specified check. If it is not in compliance, the
     check method will return a value which will be supplied to the.
+
+    Audits declaring the resources they touch with resources() may be run
+    concurrently with audits touching other resources. Audits which are not
+    threadsafe always run in the thread that called run_audits().
     """
+    # Set to False for audits which must run in the calling thread, e.g.
+    # because they use unitdata, whose sqlite connection is bound to the
+    # thread that opened it.
+    threadsafe = True
+
     def __init__(self, *args, **kwargs):
         self.unless = kwargs.get('unless', None)
         super(BaseAudit, self).__init__()
 
+    def fingerprint_paths(self):
+        """Returns the paths whose stat information forms part of this
+        audit's fingerprint.
+
+        None means the stat information of a few paths cannot tell whether
+        the system has drifted, e.g. for audits of apt settings or of whole
+        directory trees, and the audit is never skipped.
+        """
+        return None
+
+    def resources(self):
+        """Returns the set of resources this audit reads or changes.
+
+        Resources are absolute paths, which conflict with any path beneath
+        them, or 'service:<name>' for services the audit may restart. None
+        means the audit may touch anything and is never run concurrently with
+        another audit.
+        """
+        return None
+
     def ensure_compliance(self):
         """Checks to see if the current hardening check is in compliance or
         not.
@@ -33,6 +94,16 @@ class BaseAudit(object):  # NO-QA
         """
         pass
 
+    def compliant(self):
+        """Returns True if the system is currently in compliance with this
+        audit.
+
+        Used after ensure_compliance() to decide whether the audit may be
+        skipped by later incremental passes. Audits which cannot tell return
+        False and so are always run.
+        """
+        return False
+
     def _take_action(self):
         """Determines whether to perform the action or not.
 
@@ -52,3 +123,199 @@ class BaseAudit(object):  # NO-QA
             return not self.unless()
 
         return not self.unless
+
+
+def _stable(value):
+    """Returns a representation of value that is stable across processes."""
+    if value is None or isinstance(value, (six.string_types, bool, float) +
+                                   six.integer_types):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_stable(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(_stable(v) for v in value)
+    if isinstance(value, dict):
+        return sorted((str(k), _stable(v)) for k, v in six.iteritems(value))
+    return getattr(value, '__name__', value.__class__.__name__)
+
+
+def _path_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime,
+            st.st_ino)
+
+
+def audit_fingerprint(check, settings=None):
+    """Returns an (identity, state) tuple of digests for an audit.
+
+    The identity covers the audit class, its inputs and the hardening
+    settings it was built from. The state covers the stat information of the
+    files the audit checks, or is None if the audit cannot be fingerprinted.
+
+    :param check: the audit.
+    :param settings: hardening settings for the audit's stack module.
+    """
+    identity = repr((check.__class__.__name__, _stable(vars(check)),
+                     _stable(settings)))
+    paths = check.fingerprint_paths()
+    state = None
+    if paths is not None:
+        state = repr([_path_stat(p) for p in paths])
+        state = hashlib.md5(state.encode('utf-8')).hexdigest()
+    return (hashlib.md5(identity.encode('utf-8')).hexdigest(), state)
+
+
+def start_audit_pass(interval=FULL_AUDIT_INTERVAL):
+    """Starts an audit pass.
+
+    Every audit runs if this is a full pass: in FULL_AUDIT_HOOKS, when no full
+    pass has been recorded, or when the last one is older than interval
+    seconds. Otherwise audits whose fingerprint matches the one recorded after
+    their last compliant run are skipped.
+
+    :param interval: maximum age, in seconds, of the last full pass.
+    :returns: True if this is a full pass.
+    """
+    db = unitdata.kv()
+    last_full = db.get(AUDIT_LAST_FULL_KEY)
+    full = (hook_name() in FULL_AUDIT_HOOKS or last_full is None or
+            time.time() - last_full >= interval)
+    _audit_pass.clear()
+    _audit_pass.update({
+        'full': full,
+        'previous': {} if full else db.get(AUDIT_FINGERPRINTS_KEY, {}),
+        'current': {},
+    })
+    log("Starting %s hardening audit pass" %
+        ('full' if full else 'incremental'), level=DEBUG)
+    return full
+
+
+def full_audit_pass():
+    """Returns False only while an incremental audit pass is in progress."""
+    return _audit_pass.get('full', True)
+
+
+def finish_audit_pass():
+    """Records the fingerprints of the audits run in the current pass."""
+    if not _audit_pass:
+        return
+    db = unitdata.kv()
+    fingerprints = _audit_pass['previous']
+    for identity, state in six.iteritems(_audit_pass['current']):
+        if state is None:
+            fingerprints.pop(identity, None)
+        else:
+            fingerprints[identity] = state
+    db.set(AUDIT_FINGERPRINTS_KEY, fingerprints)
+    if _audit_pass['full']:
+        db.set(AUDIT_LAST_FULL_KEY, time.time())
+    db.flush()
+    _audit_pass.clear()
+
+
+def _conflicts(a, b):
+    """Returns True if two audits' resource sets overlap."""
+    if a is None or b is None:
+        return True
+    for x in a:
+        for y in b:
+            if x == y:
+                return True
+            if x.startswith('/') and y.startswith('/'):
+                if (x.startswith(y.rstrip('/') + '/') or
+                        y.startswith(x.rstrip('/') + '/')):
+                    return True
+    return False
+
+
+def _run_audit(check, settings, deps, done, failed):
+    """Runs a single audit once the audits it conflicts with have finished.
+
+    :returns: (audit name, wall time in seconds, exc_info or None)
+    """
+    name = check.__class__.__name__
+    start = time.time()
+    try:
+        for dep in deps:
+            dep.wait()
+        # An earlier audit raised: abandon this one, but still set done so
+        # that the audits waiting on it are released.
+        if failed:
+            return (name, 0.0, None)
+
+        start = time.time()
+        if _audit_pass:
+            identity, state = audit_fingerprint(check, settings)
+            if (state is not None and
+                    _audit_pass['previous'].get(identity) == state):
+                log("Skipping unchanged '%s' check" % (name), level=DEBUG)
+                _audit_pass['current'][identity] = state
+                return (name, time.time() - start, None)
+
+        log("Running '%s' check" % (name), level=DEBUG)
+        check.ensure_compliance()
+        if _audit_pass:
+            # Only an audit which ended compliant may be skipped later; one
+            # left non-compliant (e.g. by unless or a dry run) must rerun.
+            state = audit_fingerprint(check, settings)[1]
+            if state is not None and not check.compliant():
+                state = None
+            _audit_pass['current'][identity] = state
+        return (name, time.time() - start, None)
+    except Exception:
+        failed.append(True)
+        return (name, time.time() - start, sys.exc_info())
+    finally:
+        done.set()
+
+
+def run_audits(checks, settings=None, threads=AUDIT_THREADS):
+    """Runs audits, skipping those unchanged since their last compliant run.
+
+    Outside of an audit pass every audit is run. Audits whose resources do
+    not conflict run concurrently on a pool of threads; an audit always
+    waits for earlier audits it conflicts with. If an audit raises, audits
+    not yet started are abandoned and the first error is re-raised once the
+    running ones have finished.
+
+    :param checks: list of audits to run.
+    :param settings: hardening settings the audits were built from.
+    :param threads: maximum number of audits to run at once.
+    :returns: list of (audit name, wall time in seconds) in audit order.
+    """
+    begin = time.time()
+    started = []
+    pending = []
+    failed = []
+    pool = ThreadPool(max(1, threads))
+    try:
+        for check in checks:
+            resources = check.resources()
+            deps = [e for r, e in started if _conflicts(resources, r)]
+            done = threading.Event()
+            started.append((resources, done))
+            args = (check, settings, deps, done, failed)
+            if check.threadsafe:
+                pending.append(pool.apply_async(_run_audit, args))
+            else:
+                pending.append(_run_audit(*args))
+        results = [r if isinstance(r, tuple) else r.get() for r in pending]
+    finally:
+        pool.close()
+        pool.join()
+
+    for name, elapsed, _ in results:
+        log("Audit '%s' took %.3fs" % (name, elapsed), level=DEBUG)
+    log("Ran %d audit(s) in %.3fs (slowest: %s)" %
+        (len(results), time.time() - begin,
+         ', '.join("%s %.3fs" % (name, elapsed) for name, elapsed, _ in
+                   sorted(results, key=lambda r: -r[1])[:3])),
+        level=INFO)
+    for _, _, exc_info in results:
+        if exc_info:
+            six.reraise(*exc_info)
+    return [(name, elapsed) for name, elapsed, _ in results]
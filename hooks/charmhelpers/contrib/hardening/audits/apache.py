@@ -40,6 +40,9 @@ class DisabledModuleAudit(BaseAudit):
         else:
             self.modules = modules
 
+    def resources(self):
+        return set(['/etc/apache2', 'service:apache2'])
+
     def ensure_compliance(self):
         """Ensures that the modules are not loaded."""
         if not self.modules:
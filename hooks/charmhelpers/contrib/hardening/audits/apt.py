@@ -42,6 +42,9 @@ class AptConfig(BaseAudit):
                     "(expected='%s')" %
                     (cfg['key'], value, cfg['expected']), level=WARNING)
 
+    def resources(self):
+        return set(['apt'])
+
     def ensure_compliance(self):
         self.verify_config()
 
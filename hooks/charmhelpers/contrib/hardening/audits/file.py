@@ -14,7 +14,6 @@
 
 import grp
 import os
-import pwd
 import re
 
 from subprocess import (
@@ -68,6 +67,12 @@ class BaseFileAudit(BaseAudit):
         else:
             self.paths = paths
 
+    def fingerprint_paths(self):
+        return self.paths
+
+    def resources(self):
+        return set(self.paths)
+
     def ensure_compliance(self):
         """Ensure that the all registered files comply to registered criteria.
         """
@@ -94,6 +99,15 @@ class BaseFileAudit(BaseAudit):
         """
         raise NotImplementedError
 
+    def compliant(self):
+        for p in self.paths:
+            if os.path.exists(p):
+                if not self.is_compliant(p):
+                    return False
+            elif self.always_comply:
+                return False
+        return True
+
     def comply(self, path):
         """Enforces the compliance of a path.
 
@@ -133,7 +147,7 @@ class FilePermissionAudit(BaseFileAudit):
     @user.setter
     def user(self, name):
         try:
-            user = pwd.getpwnam(name)
+            user = utils.get_user(name)
         except KeyError:
             log('Unknown user %s' % name, level=ERROR)
             user = None
@@ -148,7 +162,7 @@ class FilePermissionAudit(BaseFileAudit):
         try:
             group = None
             if name:
-                group = grp.getgrnam(name)
+                group = utils.get_group(name)
             else:
                 group = grp.getgrgid(self.user.pw_gid)
         except KeyError:
@@ -188,9 +202,12 @@ class FilePermissionAudit(BaseFileAudit):
         return compliant
 
     def comply(self, path):
-        """Issues a chown and chmod to the file paths specified."""
-        utils.ensure_permissions(path, self.user.pw_name, self.group.gr_name,
-                                 self.mode)
+        """Issues a chown and chmod to the file paths specified.
+
+        :returns: the number of paths changed.
+        """
+        return utils.ensure_permissions(path, self.user.pw_name,
+                                        self.group.gr_name, self.mode)
 
 
 class DirectoryPermissionAudit(FilePermissionAudit):
@@ -202,6 +219,10 @@ class DirectoryPermissionAudit(FilePermissionAudit):
                                                        mode, **kwargs)
         self.recursive = recursive
 
+    def fingerprint_paths(self):
+        # Drift anywhere beneath the directories would go unnoticed.
+        return None if self.recursive else self.paths
+
     def is_compliant(self, path):
         """Checks if the directory is compliant.
 
@@ -230,9 +251,12 @@ class DirectoryPermissionAudit(FilePermissionAudit):
         return compliant
 
     def comply(self, path):
-        for root, dirs, _ in os.walk(path):
-            if len(dirs) > 0:
-                super(DirectoryPermissionAudit, self).comply(root)
+        # A directory with subdirectories has its whole tree, files
+        # included, brought to the audit's mode; one without is left alone.
+        if not next(os.walk(path), (None, []))[1]:
+            return 0
+        return utils.ensure_permissions(path, self.user.pw_name,
+                                        self.group.gr_name, self.mode)
 
 
 class ReadOnly(BaseFileAudit):
@@ -333,6 +357,9 @@ class TemplatedFile(BaseFileAudit):
     permissions, then generates a hashsum with which to check the content
     changed.
     """
+    # Template checksums are kept in unitdata.
+    threadsafe = False
+
     def __init__(self, path, context, template_dir, mode, user='root',
                  group='root', service_actions=None, **kwargs):
         self.context = context
@@ -362,6 +389,11 @@ class TemplatedFile(BaseFileAudit):
 
         return False
 
+    def resources(self):
+        services = set('service:%s' % a['service']
+                       for a in self.service_actions or [])
+        return set(self.paths) | services
+
     def run_service_actions(self):
         """Run any actions on services requested."""
         if not self.service_actions:
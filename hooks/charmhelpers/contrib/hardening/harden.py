@@ -22,13 +22,21 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
 )
+from charmhelpers.contrib.hardening.audits import (
+    FULL_AUDIT_INTERVAL,
+    finish_audit_pass,
+    start_audit_pass,
+)
 from charmhelpers.contrib.hardening.host.checks import run_os_checks
 from charmhelpers.contrib.hardening.ssh.checks import run_ssh_checks
 from charmhelpers.contrib.hardening.mysql.checks import run_mysql_checks
 from charmhelpers.contrib.hardening.apache.checks import run_apache_checks
 
+# Stack modules already applied by this process (i.e. during this hook).
+_hardened = set()
+
 
-def harden(overrides=None):
+def harden(overrides=None, interval=FULL_AUDIT_INTERVAL):
     """Hardening decorator.
 
     This is the main entry point for running the hardening stack. In order to
@@ -37,14 +45,19 @@ def harden(overrides=None):
     one or more of the supported modules. Setting these will cause the
     corresponding hardening code to be run when the hook fires.
 
-    This decorator can and should be applied to more than one hook or function
-    such that hardening modules are called multiple times. This is because
-    subsequent calls will perform auditing checks that will report any changes
-    to resources hardened by the first run (and possibly perform compliance
-    actions as a result of any detected infractions).
+    This decorator can and should be applied to more than one hook such that
+    hardening modules are run from every hook that may change the resources
+    they harden. Each module is applied at most once per hook, so stacked
+    decorators do not repeat work.
+
+    Audits are incremental: an audit whose inputs, settings and file stat
+    information are unchanged since its last compliant run is skipped. A full
+    pass is made in the install, config-changed and upgrade-charm hooks and
+    whenever the last full pass is older than interval seconds.
 
     :param overrides: Optional list of stack modules used to override those
                       provided with 'harden' config.
+    :param interval: Maximum age, in seconds, of the last full audit pass.
     :returns: Returns value returned by decorated function once executed.
     """
     def _harden_inner1(f):
@@ -56,23 +69,31 @@ def harden(overrides=None):
                                        ('mysql', run_mysql_checks),
                                        ('apache', run_apache_checks)])
 
-            enabled = overrides or (config("harden") or "").split()
+            enabled = list(overrides or (config("harden") or "").split())
             if enabled:
                 modules_to_run = []
                 # modules will always be performed in the following order
                 for module, func in six.iteritems(RUN_CATALOG):
                     if module in enabled:
                         enabled.remove(module)
-                        modules_to_run.append(func)
+                        if module in _hardened:
+                            log("Hardening module '%s' already applied - "
+                                "skipping" % (module), level=DEBUG)
+                            continue
+                        modules_to_run.append((module, func))
 
                 if enabled:
                     log("Unknown hardening modules '%s' - ignoring" %
                         (', '.join(enabled)), level=WARNING)
 
-                for hardener in modules_to_run:
-                    log("Executing hardening module '%s'" %
-                        (hardener.__name__), level=DEBUG)
-                    hardener()
+                if modules_to_run:
+                    start_audit_pass(interval)
+                    for module, hardener in modules_to_run:
+                        log("Executing hardening module '%s'" %
+                            (hardener.__name__), level=DEBUG)
+                        hardener()
+                        _hardened.add(module)
+                    finish_audit_pass()
             else:
                 log("No hardening applied to '%s'" % (f.__name__), level=DEBUG)
 
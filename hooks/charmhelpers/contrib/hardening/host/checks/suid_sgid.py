@@ -12,15 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
+import gzip
+import json
+import os
+
+from multiprocessing.pool import ThreadPool
+from stat import (
+    S_ISDIR,
+    S_ISGID,
+    S_ISREG,
+    S_ISUID,
+)
 
 from charmhelpers.core.hookenv import (
     log,
+    DEBUG,
     INFO,
+    WARNING,
 )
+from charmhelpers.contrib.hardening.audits import full_audit_pass
 from charmhelpers.contrib.hardening.audits.file import NoSUIDSGIDAudit
 from charmhelpers.contrib.hardening import utils
 
+SUID_SGID_INDEX = '.hardening-suid-sgid-index.json.gz'
+# Where the index is kept when there is no unit state database or charm
+# directory to keep it alongside.
+SUID_SGID_STATE_DIR = '/var/lib/charm-hardening'
+
 
 BLACKLIST = ['/usr/bin/rcp', '/usr/bin/rlogin', '/usr/bin/rsh',
              '/usr/libexec/openssh/ssh-keysign',
@@ -109,21 +127,200 @@ def get_audits():
         # suid/sgid bits then find all of the paths which have the suid/sgid
         # bit set and then remove the whitelisted paths.
         root_path = settings['environment']['root_path']
-        unknown_paths = find_paths_with_suid_sgid(root_path) - set(whitelist)
+        found = find_paths_with_suid_sgid(
+            root_path,
+            prune_paths=settings['security']['suid_sgid_prune_paths'],
+            cross_mounts=settings['security']['suid_sgid_cross_mounts'],
+            threads=settings['security']['suid_sgid_scan_threads'],
+            incremental=not full_audit_pass())
+        unknown_paths = found - set(whitelist)
         checks.append(NoSUIDSGIDAudit(unknown_paths, unless=dry_run))
 
     return checks
 
 
-def find_paths_with_suid_sgid(root_path):
+def _has_suid_sgid(path):
+    """Returns True if path is a regular file with an suid or sgid bit set.
+
+    Directories are deliberately not reported: the sgid bit on a directory
+    such as /var/mail or /var/local makes new files inherit its group and
+    grants no privileges, and removing it would break that inheritance.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return S_ISREG(st.st_mode) and bool(st.st_mode & (S_ISUID | S_ISGID))
+
+
+def _list_dir(path):
+    """Returns the (name, is_dir) entries of a directory, without following
+    symlinks.
+    """
+    if hasattr(os, 'scandir'):
+        return [(e.name, e.is_dir(follow_symlinks=False))
+                for e in os.scandir(path)]
+
+    entries = []
+    for name in os.listdir(path):
+        try:
+            st = os.lstat(os.path.join(path, name))
+        except OSError:
+            continue
+        entries.append((name, S_ISDIR(st.st_mode)))
+    return entries
+
+
+def _index_path():
+    """Returns the path of the suid/sgid index cache file, kept alongside
+    the unit state database.
+    """
+    if os.environ.get('UNIT_STATE_DB'):
+        state_dir = os.path.dirname(
+            os.path.abspath(os.environ['UNIT_STATE_DB']))
+    else:
+        state_dir = os.environ.get('CHARM_DIR') or SUID_SGID_STATE_DIR
+    return os.path.join(state_dir, SUID_SGID_INDEX)
+
+
+def _load_index(path, options):
+    """Loads the index written by a previous scan with the same options.
+
+    :returns: dict of directory: [mtime, suid/sgid file names]
+    """
+    try:
+        with gzip.open(path, 'rb') as f:
+            cache = json.loads(f.read().decode('UTF-8'))
+    except (IOError, OSError, EOFError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('options') != options:
+        return {}
+    hits = cache.get('hits', {})
+    return dict((d, [mtime, hits.get(d, [])])
+                for d, mtime in cache.get('mtimes', {}).items())
+
+
+def _save_index(path, options, index):
+    cache = {'options': options,
+             'mtimes': dict((d, entry[0]) for d, entry in index.items()),
+             'hits': dict((d, entry[1]) for d, entry in index.items()
+                          if entry[1])}
+    tmp_path = '%s.tmp' % path
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(json.dumps(cache, separators=(',', ':')).encode('UTF-8'))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log("Unable to write suid/sgid index %s: %s" % (path, e),
+            level=WARNING)
+
+
+def _scan_dir(path, root_dev, prune_paths, cross_mounts, index, children):
+    """Scans a single directory.
+
+    If the directory's mtime matches the index its entries cannot have
+    changed, so its subdirectories are taken from the index and only the
+    previously found suid/sgid files are re-checked.
+
+    :returns: (index entry of [mtime, suid/sgid file names], subdirectories)
+              or None if the directory is not to be scanned.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not S_ISDIR(st.st_mode):
+        return None
+    if not cross_mounts and st.st_dev != root_dev:
+        return None
+
+    previous = index.get(path)
+    if previous and previous[0] == st.st_mtime:
+        files = [name for name in previous[1]
+                 if _has_suid_sgid(os.path.join(path, name))]
+        return [st.st_mtime, files], children.get(path, [])
+
+    files = []
+    subdirs = []
+    try:
+        entries = _list_dir(path)
+    except OSError:
+        return None
+    for name, is_dir in entries:
+        full_path = os.path.join(path, name)
+        if is_dir:
+            if full_path not in prune_paths:
+                subdirs.append(full_path)
+        elif _has_suid_sgid(full_path):
+            files.append(name)
+    return [st.st_mtime, files], subdirs
+
+
+def find_paths_with_suid_sgid(root_path, prune_paths=None, cross_mounts=True,
+                              threads=8, incremental=False, index_path=None):
     """Finds all paths/files which have an suid/sgid bit enabled.
 
-    Starting with the root_path, this will recursively find all paths which
-    have an suid or sgid bit set.
+    Starting with the root_path, this will recursively find all regular files
+    which have an suid or sgid bit set; sgid directories are not reported.
+    Each level of the directory tree is walked
+    in parallel by a pool of threads.
+
+    The mtime and suid/sgid file names of every directory are kept in a
+    compressed index cache file, which is only rewritten when it changes. An
+    incremental scan only lists directories whose mtime has changed since
+    the index was written; files which gain an suid/sgid bit in an
+    unchanged directory are found by the next full scan.
+
+    :param root_path: the directory to start the search from.
+    :param prune_paths: paths which are not descended into.
+    :param cross_mounts: if False, do not descend into other filesystems.
+    :param threads: number of threads walking the tree.
+    :param incremental: reuse the entries of unchanged directories.
+    :param index_path: index cache file, by default alongside the unit state
+                       database.
+    :returns: set of suid/sgid file paths.
     """
-    cmd = ['find', root_path, '-perm', '-4000', '-o', '-perm', '-2000',
-           '-type', 'f', '!', '-path', '/proc/*', '-print']
+    root_path = os.path.normpath(root_path)
+    prune_paths = set(os.path.normpath(p) for p in prune_paths or [])
+    index_path = index_path or _index_path()
+    options = {'root_path': root_path, 'prune_paths': sorted(prune_paths),
+               'cross_mounts': bool(cross_mounts)}
+    previous = _load_index(index_path, options)
+    index = previous if incremental else {}
+    # Subdirectories of each indexed directory, recovered from the index
+    # keys, for directories which are unchanged and so are not listed.
+    children = {}
+    for path in index:
+        if path != root_path:
+            children.setdefault(os.path.dirname(path), []).append(path)
+    try:
+        root_dev = os.lstat(root_path).st_dev
+    except OSError:
+        return set()
+
+    new_index = {}
+    pool = ThreadPool(max(1, threads))
+    try:
+        frontier = [root_path]
+        while frontier:
+            results = pool.map(
+                lambda d: _scan_dir(d, root_dev, prune_paths, cross_mounts,
+                                    index, children), frontier)
+            subdirs = []
+            for path, result in zip(frontier, results):
+                if result is not None:
+                    new_index[path] = result[0]
+                    subdirs.extend(result[1])
+            frontier = subdirs
+    finally:
+        pool.close()
+        pool.join()
 
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, _ = p.communicate()
-    return set(out.split('\n'))
+    if new_index != previous:
+        _save_index(index_path, options, new_index)
+    log("Scanned %d directories for suid/sgid files" % (len(new_index)),
+        level=DEBUG)
+    return set(os.path.join(path, name)
+               for path, entry in new_index.items() for name in entry[1])
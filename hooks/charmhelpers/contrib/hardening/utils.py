@@ -119,37 +119,106 @@ def get_settings(modules):
     return __SETTINGS__[modules]
 
 
+_users = {}
+_groups = {}
+
+
+def get_user(name):
+    """Look up a user by name, memoizing the result.
+
+    :raises KeyError: if the user does not exist.
+    """
+    if name not in _users:
+        _users[name] = pwd.getpwnam(name)
+    return _users[name]
+
+
+def get_group(name):
+    """Look up a group by name, memoizing the result.
+
+    :raises KeyError: if the group does not exist.
+    """
+    if name not in _groups:
+        _groups[name] = grp.getgrnam(name)
+    return _groups[name]
+
+
+def _list_dir(path):
+    """Returns the non-hidden entries of a directory as (path, is_dir)."""
+    if hasattr(os, 'scandir'):
+        return [(e.path, e.is_dir()) for e in os.scandir(path)
+                if not e.name.startswith('.')]
+
+    return [(p, os.path.isdir(p)) for p in glob.glob("%s/*" % (path))]
+
+
+def _apply_permissions(path, uid, gid, permissions, st=None):
+    """Sets ownership and mode of path if they differ from those requested.
+
+    :returns: True if path was changed.
+    """
+    if st is None:
+        st = os.stat(path)
+    changed = False
+    if st.st_uid != uid or st.st_gid != gid:
+        os.chown(path, uid, gid)
+        changed = True
+    if st.st_mode & 0o7777 != permissions:
+        os.chmod(path, permissions)
+        changed = True
+    return changed
+
+
 def ensure_permissions(path, user, group, permissions, maxdepth=-1):
     """Ensure permissions for path.
 
     If path is a file, apply to file and return. If path is a directory,
     apply recursively (if required) to directory contents and return.
 
+    Paths are only changed if their ownership or mode differs from that
+    requested, so compliant paths keep their ctime.
+
     :param user: user name
     :param group: group name
     :param permissions: octal permissions
     :param maxdepth: maximum recursion depth. A negative maxdepth allows
                      infinite recursion and maxdepth=0 means no recursion.
-    :returns: None
+    :returns: number of paths changed
     """
     if not os.path.exists(path):
         log("File '%s' does not exist - cannot set permissions" % (path),
             level=WARNING)
-        return
-
-    _user = pwd.getpwnam(user)
-    os.chown(path, _user.pw_uid, grp.getgrnam(group).gr_gid)
-    os.chmod(path, permissions)
-
-    if maxdepth == 0:
-        log("Max recursion depth reached - skipping further recursion",
-            level=DEBUG)
-        return
-    elif maxdepth > 0:
-        maxdepth -= 1
-
-    if os.path.isdir(path):
-        contents = glob.glob("%s/*" % (path))
-        for c in contents:
-            ensure_permissions(c, user=user, group=group,
-                               permissions=permissions, maxdepth=maxdepth)
+        return 0
+
+    uid = get_user(user).pw_uid
+    gid = get_group(group).gr_gid
+    corrected = 0
+    if _apply_permissions(path, uid, gid, permissions):
+        corrected += 1
+
+    pending = [(path, maxdepth)] if os.path.isdir(path) else []
+    while pending:
+        dirpath, depth = pending.pop()
+        if depth == 0:
+            log("Max recursion depth reached - skipping further recursion",
+                level=DEBUG)
+            continue
+        elif depth > 0:
+            depth -= 1
+
+        for child, is_dir in _list_dir(dirpath):
+            try:
+                if _apply_permissions(child, uid, gid, permissions):
+                    corrected += 1
+            except OSError:
+                # e.g. a dangling symlink
+                log("Cannot set permissions on '%s'" % (child),
+                    level=WARNING)
+                continue
+            if is_dir:
+                pending.append((child, depth))
+
+    if corrected:
+        log("Corrected permissions of %d path(s) under '%s'" %
+            (corrected, path), level=INFO)
+    return corrected
@@ -12,17 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import binascii
+import bisect
 import glob
 import re
+import struct
 import subprocess
 import six
 import socket
+import time
 
 from functools import partial
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    cached,
     config,
+    flush,
     log,
     network_get_primary_address,
     unit_get,
@@ -86,6 +92,122 @@ def _get_ipv6_network_from_address(address):
                                         netmask))
 
 
+class InterfaceIndex(object):
+    """Addresses configured on the host's network interfaces.
+
+    Built once from netifaces; interface networks are bucketed by prefix
+    length so that finding the interface which owns an address takes one
+    dict lookup per distinct prefix length rather than a scan of every
+    interface, and are kept sorted by first address so that finding the
+    interface addresses within a network is a bisect.
+
+    Where several addresses match, the one a scan in netifaces.interfaces()
+    order would have reached first wins.
+    """
+
+    def __init__(self):
+        self.interfaces = netifaces.interfaces()
+        self._ifaddresses = {}
+        self._by_addr = {}
+        self._by_prefix = {4: {}, 6: {}}
+        self._sorted = {4: [], 6: []}
+
+        for iface in self.interfaces:
+            addresses = netifaces.ifaddresses(iface)
+            self._ifaddresses[iface] = addresses
+            for inet_type in addresses:
+                for addr in addresses[inet_type]:
+                    _addr = addr.get('addr')
+                    if _addr:
+                        self._by_addr.setdefault(_addr.split('%')[0], iface)
+
+            for i, addr in enumerate(addresses.get(netifaces.AF_INET, [])):
+                network = netaddr.IPNetwork("%s/%s" % (addr['addr'],
+                                                       addr['netmask']))
+                # Only the first IPv4 address of an interface is considered
+                # when resolving the interface for an address.
+                self._add(iface, addr, network, bindable=(i == 0))
+
+            for addr in addresses.get(netifaces.AF_INET6, []):
+                network = _get_ipv6_network_from_address(addr)
+                if network:
+                    self._add(iface, addr, network)
+
+        for version in self._sorted:
+            self._sorted[version].sort(key=lambda entry: entry[:2])
+
+    def _add(self, iface, addr, network, bindable=True):
+        # The second field records the order in which a scan of the
+        # interfaces would have reached this address.
+        order = len(self._sorted[4]) + len(self._sorted[6])
+        entry = (network.first, order, network.last, iface, addr, network)
+        self._sorted[network.version].append(entry)
+        if bindable:
+            buckets = self._by_prefix[network.version]
+            bucket = buckets.setdefault(network.prefixlen, {})
+            bucket.setdefault(network.first, []).append(entry)
+
+    def ifaddresses(self, iface):
+        """Return the netifaces.ifaddresses() result for iface."""
+        if iface not in self._ifaddresses:
+            raise ValueError("You must specify a valid interface name.")
+        return self._ifaddresses[iface]
+
+    def iface_for_configured_address(self, address):
+        """Return the interface address is configured on, or None."""
+        return self._by_addr.get(address)
+
+    def lookup(self, address):
+        """Return the (iface, addr, network) whose network contains address.
+
+        :param address: netaddr.IPAddress
+        :returns: tuple or None if no interface network contains address.
+        """
+        value = int(address)
+        width = 32 if address.version == 4 else 128
+        best = None
+        for prefixlen, bucket in six.iteritems(
+                self._by_prefix[address.version]):
+            mask = ((1 << width) - 1) ^ ((1 << (width - prefixlen)) - 1)
+            for entry in bucket.get(value & mask, []):
+                if best is None or entry[1] < best[1]:
+                    best = entry
+        if best is None:
+            return None
+        return best[3:]
+
+    def address_in_network(self, network):
+        """Return the first interface address whose network lies within
+        network, or None.
+
+        :param network: netaddr.IPNetwork
+        """
+        entries = self._sorted[network.version]
+        start = bisect.bisect_left(entries, (network.first,))
+        best = None
+        for entry in entries[start:]:
+            if entry[0] > network.last:
+                break
+            if entry[2] <= network.last and (best is None or
+                                             entry[1] < best[1]):
+                best = entry
+        if best is None:
+            return None
+        return str(best[5].ip)
+
+
+@cached
+def interface_index():
+    """Return the InterfaceIndex for this hook execution."""
+    return InterfaceIndex()
+
+
+def invalidate_interface_index():
+    """Discard the cached InterfaceIndex, e.g. after reconfiguring
+    interfaces, so that the next lookup rebuilds it."""
+    flush('interface_index')
+
+
 def get_address_in_network(network, fallback=None, fatal=False):
     """Get an IPv4 or IPv6 address within the network from the host.
 
@@ -107,21 +229,10 @@ def get_address_in_network(network, fallback=None, fatal=False):
     networks = network.split() or [network]
     for network in networks:
         _validate_cidr(network)
-        network = netaddr.IPNetwork(network)
-        for iface in netifaces.interfaces():
-            addresses = netifaces.ifaddresses(iface)
-            if network.version == 4 and netifaces.AF_INET in addresses:
-                for addr in addresses[netifaces.AF_INET]:
-                    cidr = netaddr.IPNetwork("%s/%s" % (addr['addr'],
-                                                        addr['netmask']))
-                    if cidr in network:
-                        return str(cidr.ip)
-
-            if network.version == 6 and netifaces.AF_INET6 in addresses:
-                for addr in addresses[netifaces.AF_INET6]:
-                    cidr = _get_ipv6_network_from_address(addr)
-                    if cidr and cidr in network:
-                        return str(cidr.ip)
+        address = interface_index().address_in_network(
+            netaddr.IPNetwork(network))
+        if address:
+            return address
 
     if fallback is not None:
         return fallback
@@ -182,34 +293,16 @@ def _get_for_address(address, key):
     :returns str: Requested attribute or None if address is not bindable.
     """
     address = netaddr.IPAddress(address)
-    for iface in netifaces.interfaces():
-        addresses = netifaces.ifaddresses(iface)
-        if address.version == 4 and netifaces.AF_INET in addresses:
-            addr = addresses[netifaces.AF_INET][0]['addr']
-            netmask = addresses[netifaces.AF_INET][0]['netmask']
-            network = netaddr.IPNetwork("%s/%s" % (addr, netmask))
-            cidr = network.cidr
-            if address in cidr:
-                if key == 'iface':
-                    return iface
-                else:
-                    return addresses[netifaces.AF_INET][0][key]
-
-        if address.version == 6 and netifaces.AF_INET6 in addresses:
-            for addr in addresses[netifaces.AF_INET6]:
-                network = _get_ipv6_network_from_address(addr)
-                if not network:
-                    continue
+    match = interface_index().lookup(address)
+    if match is None:
+        return None
 
-                cidr = network.cidr
-                if address in cidr:
-                    if key == 'iface':
-                        return iface
-                    elif key == 'netmask' and cidr:
-                        return str(cidr).split('/')[1]
-                    else:
-                        return addr[key]
-    return None
+    iface, addr, network = match
+    if key == 'iface':
+        return iface
+    elif address.version == 6 and key == 'netmask':
+        return str(network.prefixlen)
+    return addr[key]
 
 
 get_iface_for_address = partial(_get_for_address, key='iface')
@@ -275,7 +368,8 @@ def get_iface_addr(iface='eth0', inet_type='AF_INET', inc_aliases=False,
     except AttributeError:
         raise Exception("Unknown inet type '%s'" % str(inet_type))
 
-    interfaces = netifaces.interfaces()
+    index = interface_index()
+    interfaces = index.interfaces
     if inc_aliases:
         ifaces = []
         for _iface in interfaces:
@@ -298,7 +392,7 @@ def get_iface_addr(iface='eth0', inet_type='AF_INET', inc_aliases=False,
 
     addresses = []
     for netiface in ifaces:
-        net_info = netifaces.ifaddresses(netiface)
+        net_info = index.ifaddresses(netiface)
         if inet_num in net_info:
             for entry in net_info[inet_num]:
                 if 'addr' in entry and entry['addr'] not in exc_list:
@@ -316,21 +410,10 @@ get_ipv4_addr = partial(get_iface_addr, inet_type='AF_INET')
 
 def get_iface_from_addr(addr):
     """Work out on which interface the provided address is configured."""
-    for iface in netifaces.interfaces():
-        addresses = netifaces.ifaddresses(iface)
-        for inet_type in addresses:
-            for _addr in addresses[inet_type]:
-                _addr = _addr['addr']
-                # link local
-                ll_key = re.compile("(.+)%.*")
-                raw = re.match(ll_key, _addr)
-                if raw:
-                    _addr = raw.group(1)
-
-                if _addr == addr:
-                    log("Address '%s' is configured on iface '%s'" %
-                        (addr, iface))
-                    return iface
+    iface = interface_index().iface_for_configured_address(addr)
+    if iface:
+        log("Address '%s' is configured on iface '%s'" % (addr, iface))
+        return iface
 
     msg = "Unable to infer net iface on which '%s' is configured" % (addr)
     raise Exception(msg)
@@ -350,6 +433,50 @@ def sniff_iface(f):
     return iface_sniffer
 
 
+IF_INET6 = '/proc/net/if_inet6'
+IPV6_SCOPE_GLOBAL = 0x00
+IFA_F_TEMPORARY = 0x01
+IFA_F_PERMANENT = 0x80
+LINK_LOCAL_KEY = re.compile("^fe80::..(.+)%(.+)")
+
+
+@cached
+def get_ipv6_addr_flags(path=IF_INET6):
+    """Return the IPv6 addresses configured on this host, read from procfs.
+
+    Each line of /proc/net/if_inet6 holds the address, interface index,
+    prefix length, scope and flags (all hex) followed by the interface
+    name; this gives the same scope/temporary/dynamic information as
+    'ip addr show' without a subprocess.
+
+    :param path: path to the if_inet6 table.
+    :returns: list of dicts with keys addr (netaddr.IPAddress), iface,
+              prefixlen, scope, temporary and dynamic.
+    """
+    entries = []
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError:
+        return entries
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 6:
+            continue
+        flags = int(fields[4], 16)
+        entries.append({
+            'addr': netaddr.IPAddress(int(fields[0], 16), 6),
+            'iface': fields[5],
+            'prefixlen': int(fields[2], 16),
+            'scope': int(fields[3], 16),
+            'temporary': bool(flags & IFA_F_TEMPORARY),
+            # 'ip addr' reports addresses without IFA_F_PERMANENT as dynamic
+            'dynamic': not flags & IFA_F_PERMANENT,
+        })
+    return entries
+
+
 @sniff_iface
 def get_ipv6_addr(iface=None, inc_aliases=False, fatal=True, exc_list=None,
                   dynamic_only=True):
@@ -378,9 +505,9 @@ def get_ipv6_addr(iface=None, inc_aliases=False, fatal=True, exc_list=None,
 
     if addresses:
         global_addrs = []
+        eui_64_mac = None
         for addr in addresses:
-            key_scope_link_local = re.compile("^fe80::..(.+)%(.+)")
-            m = re.match(key_scope_link_local, addr)
+            m = re.match(LINK_LOCAL_KEY, addr)
             if m:
                 eui_64_mac = m.group(1)
                 iface = m.group(2)
@@ -389,24 +516,21 @@ def get_ipv6_addr(iface=None, inc_aliases=False, fatal=True, exc_list=None,
 
         if global_addrs:
             # Make sure any found global addresses are not temporary
-            cmd = ['ip', 'addr', 'show', iface]
-            out = subprocess.check_output(cmd).decode('UTF-8')
-            if dynamic_only:
-                key = re.compile("inet6 (.+)/[0-9]+ scope global.* dynamic.*")
-            else:
-                key = re.compile("inet6 (.+)/[0-9]+ scope global.*")
+            configured = set()
+            for entry in get_ipv6_addr_flags():
+                if (entry['iface'] == iface and
+                        entry['scope'] == IPV6_SCOPE_GLOBAL and
+                        not entry['temporary'] and
+                        (entry['dynamic'] or not dynamic_only)):
+                    configured.add(entry['addr'])
 
             addrs = []
-            for line in out.split('\n'):
-                line = line.strip()
-                m = re.match(key, line)
-                if m and 'temporary' not in line:
-                    # Return the first valid address we find
-                    for addr in global_addrs:
-                        if m.group(1) == addr:
-                            if not dynamic_only or \
-                                    m.group(1).endswith(eui_64_mac):
-                                addrs.append(addr)
+            for addr in global_addrs:
+                if netaddr.IPAddress(addr) not in configured:
+                    continue
+                if not dynamic_only or \
+                        (eui_64_mac and addr.endswith(eui_64_mac)):
+                    addrs.append(addr)
 
             if addrs:
                 return addrs
@@ -533,19 +657,123 @@ def get_hostname(address, fqdn=True):
         return result.split('.')[0]
 
 
-def port_has_listener(address, port):
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_LISTEN = 0x0A
+
+
+def _decode_proc_net_address(address):
+    """Decode an address:port field from /proc/net/tcp{,6}.
+
+    The address is printed as 32-bit words in host byte order.
+    """
+    host, port = address.split(':')
+    raw = b''.join(struct.pack('=I', int(host[i:i + 8], 16))
+                   for i in range(0, len(host), 8))
+    ip_addr = netaddr.IPAddress(int(binascii.hexlify(raw), 16),
+                                4 if len(raw) == 4 else 6)
+    if ip_addr.is_ipv4_mapped():
+        ip_addr = ip_addr.ipv4()
+    return ip_addr, int(port, 16)
+
+
+def get_listening_sockets(paths=PROC_NET_TCP):
+    """Return a snapshot of the TCP sockets in LISTEN state.
+
+    Reads the kernel socket tables once rather than probing each port.
+
+    :param paths: socket tables to read.
+    :returns: dict of port: set of netaddr.IPAddress bound on that port.
+    """
+    listeners = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4 or int(fields[3], 16) != TCP_LISTEN:
+                continue
+            ip_addr, port = _decode_proc_net_address(fields[1])
+            listeners.setdefault(port, set()).add(ip_addr)
+    return listeners
+
+
+def ports_have_listeners(address, ports, listeners=None):
+    """Check a list of ports for listeners against a single snapshot.
+
+    A port is considered open if something is listening on it on address
+    or on a wildcard address; a wildcard address (0.0.0.0 or ::) matches
+    a listener on any address.
+
+    @param address: an IP address or hostname
+    @param ports: list of integer ports
+    @param listeners: snapshot from get_listening_sockets(), taken if None
+    @returns list of booleans, one per port
+    """
+    if not is_ip(address):
+        return [port_has_listener(address, port, probe=True)
+                for port in ports]
+
+    if listeners is None:
+        listeners = get_listening_sockets()
+
+    address = netaddr.IPAddress(address)
+    results = []
+    for port in ports:
+        bound = listeners.get(int(port), set())
+        results.append(any(address.value == 0 or ip_addr.value == 0 or
+                           ip_addr == address for ip_addr in bound))
+    return results
+
+
+def port_has_listener(address, port, probe=False):
     """
     Returns True if the address:port is open and being listened to,
     else False.
 
     @param address: an IP address or hostname
     @param port: integer port
+    @param probe: if True, connect to the port with 'nc -z' via a
+                  subprocess rather than reading the socket tables
 
-    Note calls 'zc' via a subprocess shell
+    Note calls 'nc' via a subprocess shell if probe is set or address is
+    a hostname
     """
-    cmd = ['nc', '-z', address, str(port)]
-    result = subprocess.call(cmd)
-    return not(bool(result))
+    if probe:
+        cmd = ['nc', '-z', address, str(port)]
+        result = subprocess.call(cmd)
+        return not(bool(result))
+    return ports_have_listeners(address, [port])[0]
+
+
+def wait_for_listeners(address, ports, timeout=30, interval=1, backoff=1,
+                       max_interval=None):
+    """Wait until every port in ports has a listener on address.
+
+    @param address: an IP address or hostname
+    @param ports: list of integer ports
+    @param timeout: give up after this many seconds
+    @param interval: seconds before the second socket table snapshot
+    @param backoff: factor to grow interval by after each snapshot
+    @param max_interval: upper bound on interval, if any
+    @returns True if all ports are listening, False on timeout
+    """
+    deadline = time.time() + timeout
+    while True:
+        if all(ports_have_listeners(address, ports)):
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            log("Timed out after %ss waiting for listeners on %s" %
+                (timeout, ', '.join(str(p) for p in ports)), level=WARNING)
+            return False
+        time.sleep(min(interval, remaining))
+        interval *= backoff
+        if max_interval is not None:
+            interval = min(interval, max_interval)
 
 
 def assert_charm_supports_ipv6():
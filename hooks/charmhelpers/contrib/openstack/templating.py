@@ -13,26 +13,40 @@
 # limitations under the License.
 
 import os
+import types
+
+from contextlib import contextmanager
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    charm_dir,
     log,
     ERROR,
     INFO
 )
+from charmhelpers.core.host import (
+    journal_path,
+    path_changed,
+)
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        FileSystemLoader, ChoiceLoader, Environment, FileSystemBytecodeCache,
+        exceptions)
 except ImportError:
     apt_update(fatal=True)
     if six.PY2:
         apt_install('python-jinja2', fatal=True)
     else:
         apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        FileSystemLoader, ChoiceLoader, Environment, FileSystemBytecodeCache,
+        exceptions)
+
+BYTECODE_CACHE_DIR = '.jinja2-bytecode'
 
 
 class OSConfigException(Exception):
@@ -85,10 +99,70 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def _context_key(context):
+    """
+    Key a context generator on its class and the state it was constructed
+    with, so that equivalent generators registered for different config files
+    share a single evaluation. Plain functions are never shared.
+    """
+    if isinstance(context, (types.FunctionType, types.MethodType)):
+        return None
+    try:
+        return (context.__class__, repr(sorted(vars(context).items())))
+    except TypeError:
+        return None
+
+
+def _evaluate_context(context, key, cache=None):
+    """
+    Evaluate a context generator, reusing the result of an equivalent one
+    already evaluated into cache, if given.
+    """
+    if key is None or cache is None:
+        return context()
+    if key in cache:
+        _ctxt, state = cache[key]
+        # carry over attributes set during evaluation, eg. related and
+        # missing_data, as used by get_incomplete_context_data()
+        context.__dict__.update(state)
+        return _ctxt
+    _ctxt = context()
+    cache[key] = (_ctxt, dict(vars(context)))
+    return _ctxt
+
+
+def get_bytecode_cache():
+    """
+    Create a jinja2 bytecode cache in the charm directory, next to the
+    unit's other persistent state, so that templates are only lexed and
+    parsed again when their source changes.
+
+    Cached bytecode is stored per template file, and so per release
+    directory, and is validated against a checksum of the template source.
+
+    :returns: jinja2.FileSystemBytecodeCache, or None outside of a hook
+        environment.
+    """
+    if not charm_dir():
+        return None
+    cache_dir = os.path.join(charm_dir(), BYTECODE_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0o700)
+        except OSError as e:
+            log('Not caching template bytecode, unable to create %s: %s' %
+                (cache_dir, e), level=INFO)
+            return None
+    return FileSystemBytecodeCache(cache_dir)
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
     Responsible for constructing a template context based on those generators.
+
+    Given a cache, context generators of a class and constructor state
+    already evaluated into it are not evaluated again.
     """
     def __init__(self, config_file, contexts):
         self.config_file = config_file
@@ -99,11 +173,12 @@ class OSConfigTemplate(object):
             self.contexts = contexts
 
         self._complete_contexts = []
+        self._context_keys = [_context_key(c) for c in self.contexts]
 
-    def context(self):
+    def context(self, cache=None):
         ctxt = {}
-        for context in self.contexts:
-            _ctxt = context()
+        for context, key in zip(self.contexts, self._context_keys):
+            _ctxt = _evaluate_context(context, key, cache)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -112,13 +187,13 @@ class OSConfigTemplate(object):
                  if interface not in self._complete_contexts]
         return ctxt
 
-    def complete_contexts(self):
+    def complete_contexts(self, cache=None):
         '''
         Return a list of interfaces that have satisfied contexts.
         '''
         if self._complete_contexts:
             return self._complete_contexts
-        self.context()
+        self.context(cache)
         return self._complete_contexts
 
 
@@ -205,6 +280,7 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._context_cache = None
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -222,12 +298,54 @@ class OSConfigRenderer(object):
         """
         self.templates[config_file] = OSConfigTemplate(config_file=config_file,
                                                        contexts=contexts)
+        # write() reports changes, so restart_on_change need not hash it
+        journal_path(config_file)
         log('Registered config file: %s' % config_file, level=INFO)
 
+    @contextmanager
+    def _shared_contexts(self):
+        """
+        Evaluate each distinct context generator at most once across all
+        templates rendered within the block, e.g. for the NeutronCCContext
+        registered for several config files. Results are not kept beyond it,
+        as files, relation data or config may change between calls.
+        """
+        if self._context_cache is not None:
+            yield
+            return
+        self._context_cache = {}
+        try:
+            yield
+        finally:
+            self._context_cache = None
+
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(loader=loader,
+                                         bytecode_cache=get_bytecode_cache())
+
+    def compile_templates(self):
+        """
+        Compile every template visible for the current release, including
+        partials pulled in with {% include %}, into the bytecode cache ahead
+        of time so that later hooks skip lexing and parsing.
+
+        :returns: number of templates compiled.
+        """
+        self._get_tmpl_env()
+        if not self._tmpl_env.bytecode_cache:
+            return 0
+        compiled = 0
+        for name in self._tmpl_env.list_templates():
+            try:
+                self._tmpl_env.get_template(name)
+                compiled += 1
+            except (exceptions.TemplateError, UnicodeDecodeError) as e:
+                log('Not compiling template %s: %s' % (name, e), level=INFO)
+        log('Compiled %d templates into the bytecode cache' % compiled,
+            level=INFO)
+        return compiled
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -239,7 +357,7 @@ class OSConfigRenderer(object):
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
-        ctxt = self.templates[config_file].context()
+        ctxt = self.templates[config_file].context(self._context_cache)
 
         _tmpl = os.path.basename(config_file)
         try:
@@ -263,23 +381,43 @@ class OSConfigRenderer(object):
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is left untouched if its contents already match the
+        rendered template.
+
+        :returns: True if the file was written, False if it was unchanged.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
         _out = self.render(config_file)
+        if isinstance(_out, six.text_type):
+            _out = _out.encode('UTF-8')
+
+        if os.path.isfile(config_file):
+            with open(config_file, 'rb') as current:
+                if current.read() == _out:
+                    log('Template %s unchanged, not writing.' % config_file,
+                        level=INFO)
+                    return False
 
         with open(config_file, 'wb') as out:
             out.write(_out)
+        path_changed(config_file)
 
         log('Wrote template %s.' % config_file, level=INFO)
+        return True
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        :returns: list of the config files which were changed.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        with self._shared_contexts():
+            return [k for k in list(six.iterkeys(self.templates))
+                    if self.write(k)]
 
     def set_release(self, openstack_release):
         """
@@ -295,8 +433,9 @@ class OSConfigRenderer(object):
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        [interfaces.extend(i.complete_contexts())
-         for i in six.itervalues(self.templates)]
+        with self._shared_contexts():
+            [interfaces.extend(i.complete_contexts(self._context_cache))
+             for i in six.itervalues(self.templates)]
         return interfaces
 
     def get_incomplete_context_data(self, interfaces):
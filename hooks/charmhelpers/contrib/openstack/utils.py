@@ -65,7 +65,7 @@ from charmhelpers.contrib.storage.linux.lvm import (
 from charmhelpers.contrib.network.ip import (
     get_ipv6_addr,
     is_ipv6,
-    port_has_listener,
+    ports_have_listeners,
 )
 
 from charmhelpers.contrib.python.packages import (
@@ -77,19 +77,21 @@ from charmhelpers.core.host import (
     lsb_release,
     mounts,
     umount,
-    service_running,
+    services_running,
     service_pause,
     service_resume,
     restart_on_change_helper,
 )
 from charmhelpers.fetch import (
-    apt_cache,
+    DPKG_STATUS,
     install_remote,
     import_key as fetch_import_key,
     add_source as fetch_add_source,
     SourceConfigError,
     GPGKeyError,
-    get_upstream_version
+    get_installed_version,
+    get_upstream_version,
+    upstream_version,
 )
 
 from charmhelpers.fetch.snap import (
@@ -420,29 +422,16 @@ def get_os_codename_package(package, fatal=True):
                 # Second item in list is Version
                 return line.split()[1]
 
-    import apt_pkg as apt
-
-    cache = apt_cache()
-
-    try:
-        pkg = cache[package]
-    except:
+    version = get_installed_version(package)
+    if not version:
         if not fatal:
             return None
-        # the package is unknown to the current apt cache.
-        e = 'Could not determine version of package with no installation '\
-            'candidate: %s' % package
-        error_out(e)
-
-    if not pkg.current_ver:
-        if not fatal:
-            return None
-        # package is known, but no version is currently installed.
+        # package is unknown to dpkg, or no version is currently installed.
         e = 'Could not determine version of uninstalled package: %s' % package
         error_out(e)
 
-    vers = apt.upstream_version(pkg.current_ver.ver_str)
-    if 'swift' in pkg.name:
+    vers = upstream_version(version)
+    if 'swift' in package:
         # Fully x.y.z match for swift versions
         match = re.match('^(\d+)\.(\d+)\.(\d+)', vers)
     else:
@@ -463,7 +452,7 @@ def get_os_codename_package(package, fatal=True):
     else:
         # < Liberty co-ordinated project versions
         try:
-            if 'swift' in pkg.name:
+            if 'swift' in package:
                 return get_swift_codename(vers)
             else:
                 return OPENSTACK_CODENAMES[vers]
@@ -498,17 +487,48 @@ def get_os_version_package(pkg, fatal=True):
 # Module local cache variable for the os_release.
 _os_rel = None
 
+# Prefix of the unitdata keys under which the os_release codename is
+# persisted, one per package it was derived from.
+OS_RELEASE_KEY = 'charmhelpers.os-release'
+
+
+def _os_release_key(package):
+    return '%s.%s' % (OS_RELEASE_KEY, package)
+
 
 def reset_os_release():
     '''Unset the cached os_release version'''
     global _os_rel
     _os_rel = None
+    db = unitdata.kv()
+    db.unsetrange(prefix='%s.' % OS_RELEASE_KEY)
+    db.flush()
+
+
+def _os_release_fingerprint(package, base):
+    '''Inputs which determine the os_release codename.
+
+    The dpkg status file changes whenever packages are installed, upgraded
+    or removed, so its mtime and size stand in for the package version.
+    '''
+    try:
+        st = os.stat(DPKG_STATUS)
+        dpkg_status = [st.st_mtime, st.st_size]
+    except OSError:
+        dpkg_status = None
+    return [package, base, dpkg_status, config('openstack-origin'),
+            config('openstack-origin-git')]
 
 
 def os_release(package, base='essex', reset_cache=False):
     '''
     Returns OpenStack release codename from a cached global.
 
+    The codename is also persisted in unitdata, per package, with the state of
+    the dpkg database and the openstack-origin(-git) config it was derived
+    from, so later hooks only need to stat the dpkg status file while no
+    package or source has changed.
+
     If reset_cache then unset the cached os_release version and return the
     freshly determined version.
 
@@ -521,11 +541,20 @@ def os_release(package, base='essex', reset_cache=False):
         reset_os_release()
     if _os_rel:
         return _os_rel
+    db = unitdata.kv()
+    fingerprint = _os_release_fingerprint(package, base)
+    cached = db.get(_os_release_key(package))
+    if cached and cached.get('fingerprint') == fingerprint:
+        _os_rel = cached['release']
+        return _os_rel
     _os_rel = (
         git_os_codename_install_source(config('openstack-origin-git')) or
         get_os_codename_package(package, fatal=False) or
         get_os_codename_install_source(config('openstack-origin')) or
         base)
+    db.set(_os_release_key(package),
+           {'fingerprint': fingerprint, 'release': _os_rel})
+    db.flush()
     return _os_rel
 
 
@@ -1476,8 +1505,8 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
-    return list(zip(services, services_running)), services_running
+    running = list(services_running(services).values())
+    return list(zip(services, running)), running
 
 
 def _check_listening_on_services_ports(services, test=False):
@@ -1494,7 +1523,7 @@ def _check_listening_on_services_ports(services, test=False):
     """
     test = not(not(test))  # ensure test is True or False
     all_ports = list(itertools.chain(*services.values()))
-    ports_states = [port_has_listener('0.0.0.0', p) for p in all_ports]
+    ports_states = ports_have_listeners('0.0.0.0', all_ports)
     map_ports = OrderedDict()
     matched_ports = [p for p, opened in zip(all_ports, ports_states)
                      if opened == test]  # essentially opened xor test
@@ -1514,7 +1543,7 @@ def _check_listening_on_ports_list(ports):
     @param ports: LIST or port numbers.
     @returns [(port_num, boolean), ...], [boolean]
     """
-    ports_open = [port_has_listener('0.0.0.0', p) for p in ports]
+    ports_open = ports_have_listeners('0.0.0.0', ports)
     return zip(ports, ports_open), ports_open
 
 
@@ -1872,8 +1901,11 @@ def pausable_restart_on_change(restart_map, stopstart=False,
     see core.utils.restart_on_change() for more details.
 
     @param f: the function to decorate
-    @param restart_map: the restart map {conf_file: [services]}
+    @param restart_map: the restart map {conf_file: [services]}, or a
+                        callable returning it which is evaluated lazily
     @param stopstart: DEFAULT false; whether to stop, start or just restart
+    @param restart_functions: nonstandard functions to use to restart services
+                              {svc: func, ...} or a callable returning one
     @returns decorator to use a restart_on_change with pausability
     """
     def wrap(f):
@@ -19,7 +19,9 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import atexit as _py_atexit
 import copy
+from collections import OrderedDict
 from distutils.version import LooseVersion
 from functools import wraps
 import glob
@@ -29,6 +31,7 @@ import yaml
 import subprocess
 import sys
 import errno
+import threading
 import tempfile
 from subprocess import CalledProcessError
 
@@ -87,28 +90,112 @@ def flush(key):
         del cache[item]
 
 
+LOG_LEVELS = [DEBUG, INFO, WARNING, ERROR, CRITICAL]
+LOG_BUFFER_SIZE = 100
+
+_log_level = None
+_log_buffer = None
+_log_lock = threading.Lock()
+
+
 def log(message, level=None):
-    """Write a message to the juju log"""
+    """Write a message to the juju log
+
+    Messages below the threshold set with :func:`set_log_level` are dropped
+    without forking juju-log. If :func:`buffer_log` has been called, messages
+    are queued and written by :func:`flush_log` instead of one fork each.
+    """
+    if not _log_level_enabled(level):
+        return
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    if _log_buffer is None:
+        _juju_log([message], level)
+        return
+    with _log_lock:
+        _log_buffer.append((level, message))
+        full = len(_log_buffer) >= LOG_BUFFER_SIZE
+    if full or _log_level_index(level) >= LOG_LEVELS.index(ERROR):
+        flush_log()
+
+
+def _log_level_index(level):
+    try:
+        return LOG_LEVELS.index((level or INFO).upper())
+    except ValueError:
+        # Unknown levels are never filtered out
+        return len(LOG_LEVELS)
+
+
+def _log_level_enabled(level):
+    if _log_level is None:
+        return True
+    return _log_level_index(level) >= _log_level_index(_log_level)
+
+
+def _juju_log(messages, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
-    command += [message]
+    command += ['\n'.join(messages)]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
     try:
         subprocess.call(command)
     except OSError as e:
         if e.errno == errno.ENOENT:
-            if level:
-                message = "{}: {}".format(level, message)
-            message = "juju-log: {}".format(message)
-            print(message, file=sys.stderr)
+            for message in messages:
+                if level:
+                    message = "{}: {}".format(level, message)
+                message = "juju-log: {}".format(message)
+                print(message, file=sys.stderr)
         else:
             raise
 
 
+def set_log_level(level=None):
+    """Drop log messages below level before any juju-log call is made.
+
+    :param level: one of DEBUG, INFO, WARNING, ERROR or CRITICAL, or None to
+                  log everything (the default).
+    """
+    global _log_level
+    _log_level = level
+
+
+def buffer_log():
+    """Queue log messages in memory rather than forking juju-log per call.
+
+    Consecutive messages of the same level are written with a single juju-log
+    call when the buffer fills, when an ERROR or CRITICAL message is logged
+    and when the hook exits. The buffer is also flushed at interpreter exit
+    so that messages leading up to a hook failure are not lost.
+    """
+    global _log_buffer
+    if _log_buffer is None:
+        _log_buffer = []
+        atexit(flush_log)
+        _py_atexit.register(flush_log)
+
+
+def flush_log():
+    """Write any buffered log messages to juju-log."""
+    if not _log_buffer:
+        return
+    with _log_lock:
+        pending = list(_log_buffer)
+        del _log_buffer[:]
+    if not pending:
+        return
+    level, messages = pending[0][0], []
+    for _level, message in pending:
+        if _level != level:
+            _juju_log(messages, level)
+            level, messages = _level, []
+        messages.append(message)
+    _juju_log(messages, level)
+
+
 class Serializable(UserDict):
     """Wrapper, an object that can be serialized to yaml or json"""
 
@@ -366,9 +453,124 @@ def config(scope=None):
         return None
 
 
+class RelationSnapshot(object):
+    """An in-memory copy of the relation data visible to this unit.
+
+    Once enabled, :func:`relation_ids`, :func:`related_units` and
+    :func:`relation_get` are answered from the snapshot instead of forking
+    a hook tool per call. The snapshot is filled lazily: each relation
+    type's ids, each relation's units and each unit's full databag are
+    fetched with one hook tool call the first time they are looked up, so
+    hooks which never read relations pay nothing.
+
+    Use :func:`load_relation_snapshot`, typically registered with
+    :func:`atstart`, rather than instantiating this directly.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._relids = {}
+        self._units = {}
+        self._data = {}
+
+    def load(self):
+        """Start answering lookups from the snapshot, dropping any data
+        kept from earlier lookups."""
+        self.clear()
+        self.loaded = True
+
+    def clear(self):
+        """Drop all snapshot data and stop serving lookups from memory."""
+        self.__init__()
+
+    def relation_ids(self, reltype):
+        """Relation ids for reltype, or MARKER if reltype is None."""
+        if reltype is None:
+            return MARKER
+        if reltype not in self._relids:
+            self._relids[reltype] = _relation_ids(reltype)
+        return list(self._relids[reltype])
+
+    def related_units(self, relid):
+        """Units on relid, or MARKER if relid is None."""
+        if relid is None:
+            return MARKER
+        if relid not in self._units:
+            self._units[relid] = _related_units(relid)
+        return list(self._units[relid])
+
+    def relation_get(self, attribute=None, unit=None, rid=None):
+        """Relation data for unit on rid, or MARKER if it is unavailable."""
+        rid = rid or relation_id()
+        unit = unit or remote_unit()
+        if rid is None or unit is None:
+            return MARKER
+        if (rid, unit) not in self._data:
+            self._data[(rid, unit)] = _relation_get(unit=unit, rid=rid)
+        data = self._data[(rid, unit)]
+        if data is None:
+            return None
+        if attribute is None:
+            return dict(data)
+        return data.get(attribute)
+
+    def update(self, relid, unit, settings):
+        """Apply settings written by relation_set to a cached databag.
+
+        Only the keys being written are touched; a value of None removes
+        the key, matching relation-set semantics.
+        """
+        data = self._data.get((relid or relation_id(), unit))
+        if data is None:
+            return
+        for key, value in settings.items():
+            if value is None or value == '':
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+
+_relation_snapshot = RelationSnapshot()
+
+
+def load_relation_snapshot():
+    """Keep relation data read during this hook in memory.
+
+    Charms can register this with ``atstart(load_relation_snapshot)`` so that
+    context generators walking relation_ids()/related_units()/relation_get()
+    no longer fork a hook tool per lookup. Nothing is fetched until it is
+    first looked up.
+    """
+    _relation_snapshot.load()
+
+
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    pending = _pending_relation_settings(unit, rid)
+    if pending:
+        # Overlay settings queued by relation_set which juju has not seen yet
+        data = _relation_get_current(unit=unit, rid=rid) or {}
+        for key, value in pending.items():
+            if value is None or value == '':
+                data.pop(key, None)
+            else:
+                data[key] = value
+        if attribute is None:
+            return data
+        return data.get(attribute)
+    return _relation_get_current(attribute, unit, rid)
+
+
+def _relation_get_current(attribute=None, unit=None, rid=None):
+    if _relation_snapshot.loaded:
+        data = _relation_snapshot.relation_get(attribute, unit, rid)
+        if data is not MARKER:
+            return data
+    return _relation_get(attribute, unit, rid)
+
+
+def _relation_get(attribute=None, unit=None, rid=None):
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -387,13 +589,13 @@ def relation_get(attribute=None, unit=None, rid=None):
 
 
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
-    """Set relation information for the current unit"""
+    """Set relation information for the current unit
+
+    If :func:`queue_relation_set` has been called the settings are merged
+    into a queue keyed on relation id and written once per relation id by
+    :func:`flush_relation_set` when the hook completes.
+    """
     relation_settings = relation_settings if relation_settings else {}
-    relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"], universal_newlines=True)
-    if relation_id is not None:
-        relation_cmd_line.extend(('-r', relation_id))
     settings = relation_settings.copy()
     settings.update(kwargs)
     for key, value in settings.items():
@@ -401,7 +603,28 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # sites pass in things like dicts or numbers.
         if value is not None:
             settings[key] = "{}".format(value)
-    if accepts_file:
+    if _relation_set_queue is not None:
+        _queue_relation_settings(relation_id, settings)
+    else:
+        _relation_set(relation_id, settings)
+    if _relation_snapshot.loaded:
+        _relation_snapshot.update(relation_id, local_unit(), settings)
+    # Flush cache of any relation-gets for local unit
+    flush(local_unit())
+
+
+@cached
+def _relation_set_accepts_file():
+    """Whether relation-set supports --file; probed once per process."""
+    return "--file" in subprocess.check_output(
+        ['relation-set', '--help'], universal_newlines=True)
+
+
+def _relation_set(relation_id, settings):
+    relation_cmd_line = ['relation-set']
+    if relation_id is not None:
+        relation_cmd_line.extend(('-r', relation_id))
+    if _relation_set_accepts_file():
         # --file was introduced in Juju 1.23.2. Use it by default if
         # available, since otherwise we'll break if the relation data is
         # too big. Ideally we should tell relation-set to read the data from
@@ -418,7 +641,49 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
         subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
+
+
+_relation_set_queue = None
+
+
+def queue_relation_set():
+    """Defer relation-set calls until the hook completes.
+
+    Settings written to the same relation id during the hook are coalesced,
+    later values overriding earlier ones, and each relation id is written
+    with a single relation-set call from an :func:`atexit` callback. Juju
+    only publishes relation changes once a hook exits successfully, so this
+    does not change what remote units observe.
+    """
+    global _relation_set_queue
+    if _relation_set_queue is None:
+        _relation_set_queue = OrderedDict()
+        atexit(flush_relation_set)
+
+
+def _queue_relation_settings(rid, settings):
+    rid = rid or relation_id()
+    _relation_set_queue.setdefault(rid, {}).update(settings)
+
+
+def _pending_relation_settings(unit, rid):
+    """Queued settings for the local unit on rid, if any."""
+    if not _relation_set_queue or unit is None or unit != local_unit():
+        return None
+    return _relation_set_queue.get(rid or relation_id())
+
+
+def flush_relation_set():
+    """Write all queued relation settings, one relation-set per relation."""
+    if not _relation_set_queue:
+        return
+    pending = list(_relation_set_queue.items())
+    _relation_set_queue.clear()
+    for rid, settings in pending:
+        _relation_set(rid, settings)
+        if _relation_snapshot.loaded:
+            # the databag may have been fetched after the settings queued
+            _relation_snapshot.update(rid, local_unit(), settings)
     flush(local_unit())
 
 
@@ -437,6 +702,14 @@ def relation_clear(r_id=None):
 def relation_ids(reltype=None):
     """A list of relation_ids"""
     reltype = reltype or relation_type()
+    if _relation_snapshot.loaded:
+        relids = _relation_snapshot.relation_ids(reltype)
+        if relids is not MARKER:
+            return relids
+    return _relation_ids(reltype)
+
+
+def _relation_ids(reltype):
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
         relid_cmd_line.append(reltype)
@@ -449,6 +722,14 @@ def relation_ids(reltype=None):
 def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
+    if _relation_snapshot.loaded:
+        units = _relation_snapshot.related_units(relid)
+        if units is not MARKER:
+            return units
+    return _related_units(relid)
+
+
+def _related_units(relid):
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
@@ -19,6 +19,7 @@
 #  Nick Moffitt <nick.moffitt@canonical.com>
 #  Matthew Wedgwood <matthew.wedgwood@canonical.com>
 
+import atexit as _py_atexit
 import os
 import re
 import pwd
@@ -27,6 +28,9 @@ import grp
 import random
 import string
 import subprocess
+import sys
+import threading
+import time
 import hashlib
 import functools
 import itertools
@@ -34,7 +38,8 @@ import six
 
 from contextlib import contextmanager
 from collections import OrderedDict
-from .hookenv import log
+from multiprocessing.pool import ThreadPool
+from .hookenv import atexit, cached, log, DEBUG, WARNING
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
 
@@ -305,11 +310,76 @@ def service_running(service_name, **kwargs):
         return False
 
 
+SERVICE_STATE_PROPERTIES = ('ActiveState', 'SubState', 'MainPID')
+
+
+def service_states(service_names):
+    """Return the systemd state of several services with one query.
+
+    A single 'systemctl show' call reports ActiveState, SubState and
+    MainPID for every unit, rather than forking once per service.
+
+    :param service_names: list of service names
+    :returns: OrderedDict of service name: dict of property: value, or
+              None if the host does not use systemd or the query failed.
+    """
+    service_names = list(service_names)
+    if not service_names or not init_is_systemd():
+        return None
+    cmd = ['systemctl', 'show', '-p', ','.join(SERVICE_STATE_PROPERTIES),
+           '--'] + service_names
+    try:
+        output = subprocess.check_output(cmd).decode('UTF-8')
+    except (OSError, subprocess.CalledProcessError) as e:
+        log("Unable to query service states: {}".format(e), level=WARNING)
+        return None
+
+    # systemctl prints one blank-line separated block per unit, in the
+    # order the units were given.
+    blocks = output.strip().split('\n\n')
+    if len(blocks) != len(service_names):
+        return None
+    states = OrderedDict()
+    for service_name, block in zip(service_names, blocks):
+        state = {}
+        for line in block.splitlines():
+            key, _, value = line.partition('=')
+            state[key] = value
+        states[service_name] = state
+    return states
+
+
+def services_running(service_names):
+    """Determine whether each of several system services is running.
+
+    Uses a single service_states() query on systemd hosts, falling back to
+    service_running() for each service otherwise.
+
+    :param service_names: list of service names
+    :returns: OrderedDict of service name: boolean
+    """
+    service_names = list(service_names)
+    states = service_states(service_names)
+    running = OrderedDict()
+    for service_name in service_names:
+        if states is None:
+            running[service_name] = service_running(service_name)
+        else:
+            # 'systemctl is-active' succeeds for both of these states
+            running[service_name] = (states[service_name].get('ActiveState')
+                                     in ('active', 'reloading'))
+    return running
+
+
 SYSTEMD_SYSTEM = '/run/systemd/system'
 
 
+@cached
 def init_is_systemd():
-    """Return True if the host system uses systemd, False otherwise."""
+    """Return True if the host system uses systemd, False otherwise.
+
+    The result is cached for the rest of the hook execution.
+    """
     if lsb_release()['DISTRIB_CODENAME'] == 'trusty':
         return False
     return os.path.isdir(SYSTEMD_SYSTEM)
@@ -586,6 +656,25 @@ def path_hash(path):
     }
 
 
+_journalled_paths = set()
+_path_changes = []
+
+
+def journal_path(path):
+    """Declare that every write to path is reported with path_changed().
+
+    restart_on_change() relies on those reports for journalled paths
+    instead of hashing them before and after the decorated function runs.
+    """
+    _journalled_paths.add(path)
+
+
+def path_changed(path):
+    """Report that the contents of a journalled path have changed."""
+    for changes in _path_changes:
+        changes.add(path)
+
+
 def check_hash(path, checksum, hash_type='md5'):
     """Validate a file using a cryptographic checksum.
 
@@ -625,10 +714,16 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
     or removed. Standard wildcards are supported, see documentation
     for the 'glob' module for more information.
 
-    @param restart_map: {path_file_name: [service_name, ...]
+    restart_map may also be a callable returning the map, in which case it
+    is only evaluated when the decorated function is actually invoked rather
+    than when the decorator is applied.
+
+    @param restart_map: {path_file_name: [service_name, ...] or a callable
+                        returning one
     @param stopstart: DEFAULT false; whether to stop, start OR restart
     @param restart_functions: nonstandard functions to use to restart services
-                              {svc: func, ...}
+                              {svc: func, ...} or a callable returning one,
+                              e.g. to reload rather than restart a service
     @returns result from decorated function
     """
     def wrap(f):
@@ -649,33 +744,221 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     in the restart_map have changed after an invocation of lambda_f().
 
     @param lambda_f: function to call.
-    @param restart_map: {file: [service, ...]}
+    @param restart_map: {file: [service, ...]} or a callable returning one
     @param stopstart: whether to stop, start or restart a service
     @param restart_functions: nonstandard functions to use to restart services
-                              {svc: func, ...}
+                              {svc: func, ...} or a callable returning one
     @returns result of lambda_f()
     """
     if restart_functions is None:
         restart_functions = {}
-    checksums = {path: path_hash(path) for path in restart_map}
-    r = lambda_f()
+    elif callable(restart_functions):
+        restart_functions = restart_functions()
+    if callable(restart_map):
+        restart_map = restart_map()
+    checksums = {path: path_hash(path) for path in restart_map
+                 if path not in _journalled_paths}
+    changes = set()
+    _path_changes.append(changes)
+    try:
+        r = lambda_f()
+    finally:
+        _path_changes.pop()
     # create a list of lists of the services to restart
     restarts = [restart_map[path]
                 for path in restart_map
-                if path_hash(path) != checksums[path]]
+                if (path in changes if path not in checksums
+                    else path_hash(path) != checksums[path])]
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
-    if services_list:
-        actions = ('stop', 'start') if stopstart else ('restart',)
-        for service_name in services_list:
-            if service_name in restart_functions:
-                restart_functions[service_name](service_name)
-            else:
-                for action in actions:
-                    service(action, service_name)
+    for service_name in services_list:
+        if _restart_queue is not None:
+            _queue_restart(service_name, stopstart,
+                           restart_functions.get(service_name))
+        else:
+            _restart_service(service_name, stopstart,
+                             restart_functions.get(service_name))
     return r
 
 
+def _restart_service(service_name, stopstart=False, restart_function=None):
+    if restart_function:
+        return restart_function(service_name)
+    actions = ('stop', 'start') if stopstart else ('restart',)
+    return all([service(action, service_name) for action in actions])
+
+
+RESTART_THREADS = 4
+
+
+def _restart_dependencies(service_name, services, order, seen=None):
+    """Return the services in services which order says must be restarted
+    before service_name, following the graph through services that are
+    not being restarted."""
+    seen = set() if seen is None else seen
+    deps = set()
+    for dep in order.get(service_name, []):
+        if dep in seen:
+            continue
+        seen.add(dep)
+        if dep in services:
+            deps.add(dep)
+        else:
+            deps |= _restart_dependencies(dep, services, order, seen)
+    return deps
+
+
+def _sort_restarts(services, order):
+    """Sort services so that each follows the services it depends on,
+    otherwise keeping the order they were requested in.
+
+    :returns: list of (service name, set of dependencies)
+    """
+    deps = {s: _restart_dependencies(s, services, order) for s in services}
+    remaining = list(services)
+    placed = set()
+    ordered = []
+    while remaining:
+        for service_name in remaining:
+            if deps[service_name] <= placed:
+                break
+        else:
+            service_name = remaining[0]
+            log("Restart order for {} is cyclic; ignoring it".format(
+                service_name), level=WARNING)
+            deps[service_name] = deps[service_name] & placed
+        remaining.remove(service_name)
+        placed.add(service_name)
+        ordered.append((service_name, deps[service_name]))
+    return ordered
+
+
+def _run_restart(service_name, kwargs, deps, done, failed):
+    """Restart a single service once the services it depends on have been.
+
+    :returns: (service name, result, wall time in seconds, exc_info or None)
+    """
+    start = time.time()
+    try:
+        for dep in deps:
+            dep.wait()
+        # An earlier restart raised: abandon this one, but still set done
+        # so that the restarts waiting on it are released.
+        if failed:
+            return (service_name, None, 0.0, None)
+
+        start = time.time()
+        log("Restarting {} ({})".format(
+            service_name, 'stopstart' if kwargs.get('stopstart') else
+            'restart'), level=DEBUG)
+        result = _restart_service(service_name, **kwargs)
+        return (service_name, result, time.time() - start, None)
+    except Exception:
+        failed.append(True)
+        return (service_name, None, time.time() - start, sys.exc_info())
+    finally:
+        done.set()
+
+
+def restart_services(restarts, order=None, threads=RESTART_THREADS):
+    """Restart services, concurrently where their ordering allows.
+
+    A service is only restarted once every service that order says must
+    go before it has been; services with no ordering between them are
+    restarted at the same time on a pool of threads. If a restart raises,
+    restarts not yet started are abandoned and the first error is
+    re-raised once the running ones have finished.
+
+    :param restarts: list of (service name, {'stopstart': bool,
+                     'restart_function': func or None}) in request order.
+    :param order: {service: [services to restart before it], ...}
+    :param threads: maximum number of services to restart at once.
+    :returns: list of (service name, result, wall time in seconds) in the
+              order the restarts were started.
+    """
+    restarts = OrderedDict(restarts)
+    events = {}
+    pending = []
+    failed = []
+    pool = ThreadPool(max(1, threads))
+    try:
+        # Dependencies are always submitted first, so a restart waiting
+        # for them never holds up a pool thread they need.
+        for service_name, deps in _sort_restarts(restarts, order or {}):
+            events[service_name] = threading.Event()
+            args = (service_name, restarts[service_name],
+                    [events[dep] for dep in deps], events[service_name],
+                    failed)
+            pending.append(pool.apply_async(_run_restart, args))
+        results = [p.get() for p in pending]
+    finally:
+        pool.close()
+        pool.join()
+
+    for service_name, result, elapsed, _ in results:
+        log("Restart of {} {} after {:.3f}s".format(
+            service_name, 'failed' if result is False else 'finished',
+            elapsed), level=DEBUG)
+    for _, _, _, exc_info in results:
+        if exc_info:
+            six.reraise(*exc_info)
+    return [(service_name, result, elapsed)
+            for service_name, result, elapsed, _ in results]
+
+
+_restart_queue = None
+_restart_queue_options = {}
+
+
+def queue_restarts(order=None, threads=RESTART_THREADS):
+    """Defer restart_on_change restarts until the hook completes.
+
+    Each service is restarted at most once, from an :func:`atexit`
+    callback, however many wrapped handlers asked for it. The strongest
+    requested action is kept: a stop/start takes precedence over a plain
+    restart, and either takes precedence over a restart function unless
+    every request for the service supplied that same function. The queued
+    restarts are performed by :func:`restart_services`.
+
+    The queue is also flushed when the process exits after a failed hook,
+    as a handler may already have rewritten a service's configuration; a
+    retried hook would find the files unchanged and not restart it.
+
+    :param order: {service: [services to restart before it], ...}
+    :param threads: maximum number of services to restart at once.
+    """
+    global _restart_queue
+    _restart_queue_options.update(order=order or {}, threads=threads)
+    if _restart_queue is None:
+        _restart_queue = OrderedDict()
+        atexit(flush_restart_queue)
+        _py_atexit.register(flush_restart_queue)
+
+
+def _queue_restart(service_name, stopstart=False, restart_function=None):
+    queued = _restart_queue.get(service_name)
+    if queued is None:
+        _restart_queue[service_name] = {'stopstart': stopstart,
+                                        'restart_function': restart_function}
+        return
+    queued['stopstart'] = queued['stopstart'] or stopstart
+    if queued['restart_function'] != restart_function:
+        # A full restart was requested too; it wins over the function.
+        queued['restart_function'] = None
+
+
+def flush_restart_queue():
+    """Perform all queued restarts, once per service.
+
+    :returns: list of (service name, result, wall time in seconds)
+    """
+    if not _restart_queue:
+        return []
+    pending = list(_restart_queue.items())
+    _restart_queue.clear()
+    return restart_services(pending, **_restart_queue_options)
+
+
 def pwgen(length=None):
     """Generate a random pasword."""
     if length is None:
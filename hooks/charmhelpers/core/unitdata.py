@@ -146,6 +146,7 @@ associated to the hookname.
 
 """
 
+import atexit
 import collections
 import contextlib
 import datetime
@@ -158,6 +159,18 @@ import sys
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# Maximum number of keys bound in a single 'in (...)' query; SQLite's
+# default limit on host parameters is 999.
+_QUERY_CHUNK = 500
+
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
+
+# Cache marker for keys known to be absent from the database.
+_ABSENT = object()
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -166,6 +179,11 @@ class Storage(object):
 
     To support dicts, lists, integer, floats, and booleans values
     are automatically json encoded/decoded.
+
+    The database uses write-ahead logging. Values read or written are cached
+    in memory for the lifetime of the object. After :meth:`defer_commits`,
+    :meth:`flush` only marks the pending changes as to be committed, and a
+    single commit is made when the process exits.
     """
     def __init__(self, path=None):
         self.db_path = path
@@ -179,24 +197,52 @@ class Storage(object):
         self.cursor = self.conn.cursor()
         self.revision = None
         self._closed = False
+        self._cache = {}
+        self._defer_commits = False
+        self._commit_pending = False
         self._init()
 
     def close(self):
         if self._closed:
             return
+        if self._commit_pending:
+            self.conn.commit()
+            self._commit_pending = False
         self.flush(False)
         self.cursor.close()
         self.conn.close()
         self._closed = True
 
+    def defer_commits(self):
+        """Collapse all flushes into a single commit at process exit.
+
+        Once a flush has been deferred, a later flush(False) can no longer
+        roll back and leaves the changes made since to be committed with it.
+        """
+        if not self._defer_commits:
+            self._defer_commits = True
+            atexit.register(self._commit_deferred)
+
+    def _commit_deferred(self):
+        if self._commit_pending and not self._closed:
+            self.conn.commit()
+            self._commit_pending = False
+
+    def _get_serialized(self, key):
+        cached = self._cache.get(key)
+        if cached is None:
+            self.cursor.execute('select data from kv where key=?', [key])
+            result = self.cursor.fetchone()
+            cached = self._cache[key] = result[0] if result else _ABSENT
+        return None if cached is _ABSENT else cached
+
     def get(self, key, default=None, record=False):
-        self.cursor.execute('select data from kv where key=?', [key])
-        result = self.cursor.fetchone()
-        if not result:
+        result = self._get_serialized(key)
+        if result is None:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(json.loads(result))
+        return json.loads(result)
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -208,8 +254,9 @@ class Storage(object):
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
+        where, params = _prefix_range(key_prefix)
+        self.cursor.execute("select key, data from kv where %s" % where,
+                            params)
         result = self.cursor.fetchall()
 
         if not result:
@@ -227,14 +274,39 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        serialized = collections.OrderedDict(
+            ("%s%s" % (prefix, k), json.dumps(v)) for k, v in mapping.items())
+
+        uncached = [k for k in serialized if k not in self._cache]
+        for i in range(0, len(uncached), _QUERY_CHUNK):
+            chunk = uncached[i:i + _QUERY_CHUNK]
+            for k in chunk:
+                self._cache[k] = _ABSENT
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            for k, data in self.cursor.fetchall():
+                self._cache[k] = data
+
+        changed = [(k, v) for k, v in serialized.items()
+                   if self._cache[k] != v]
+        if not changed:
+            return
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)', changed)
+        self._cache.update(changed)
+        if self.revision:
+            self.cursor.executemany(
+                'insert or replace into kv_revisions (revision, key, data) '
+                'values (?, ?, ?)',
+                [(self.revision, k, v) for k, v in changed])
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
         self.cursor.execute('delete from kv where key=?', [key])
+        self._cache[key] = _ABSENT
         if self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
@@ -252,13 +324,17 @@ class Storage(object):
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
+            self._cache.update((key, _ABSENT) for key in keys)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
                     list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            where, params = _prefix_range(prefix)
+            self.cursor.execute('delete from kv where %s' % where, params)
+            for key in self._cache:
+                if key.startswith(prefix):
+                    self._cache[key] = _ABSENT
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values (?, ?, ?)',
@@ -273,46 +349,22 @@ class Storage(object):
         """
         serialized = json.dumps(value)
 
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
         # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
+        if self._get_serialized(key) == serialized:
+            return value
 
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+        self.cursor.execute(
+            'insert or replace into kv (key, data) values (?, ?)',
+            (key, serialized))
+        self._cache[key] = serialized
 
         # Save
         if not self.revision:
             return value
 
         self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
-
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+            'insert or replace into kv_revisions (revision, key, data) '
+            'values (?, ?, ?)', (self.revision, key, serialized))
 
         return value
 
@@ -367,13 +419,77 @@ class Storage(object):
 
     def flush(self, save=True):
         if save:
+            if self._defer_commits:
+                self._commit_pending = True
+                return
             self.conn.commit()
         elif self._closed:
             return
-        else:
+        elif not self._commit_pending:
             self.conn.rollback()
+            self._cache.clear()
+
+    def prune(self, revisions=None, days=None):
+        """Drop hook history beyond a retention limit.
+
+        Hooks, and the revisions recorded in them, are dropped if they are
+        not among the last `revisions` hooks or are older than `days` days.
+        The hook scope in progress and current values are never affected.
+
+        :param int revisions: Number of most recent hooks to keep
+        :param days: Age in days after which hooks are dropped
+        :return int: Number of rows deleted
+        """
+        clauses = []
+        params = []
+        if revisions is not None:
+            clauses.append('version <= (select max(version) from hooks) - ?')
+            params.append(revisions)
+        if days is not None:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days)
+            clauses.append('date < ?')
+            params.append(cutoff.isoformat())
+        if not clauses:
+            return 0
+        where = '(%s)' % ' or '.join(clauses)
+        if self.revision:
+            where += ' and version != ?'
+            params.append(self.revision)
+
+        self.cursor.execute('delete from hooks where %s' % where, params)
+        deleted = self.cursor.rowcount
+        self.cursor.execute(
+            'delete from kv_revisions '
+            'where revision not in (select version from hooks)')
+        return deleted + self.cursor.rowcount
+
+    def compact(self, min_free_ratio=0.25):
+        """Rebuild the database file if enough of it is unused.
+
+        Pending changes are committed first, as VACUUM cannot run inside a
+        transaction.
+
+        :param float min_free_ratio: Fraction of free pages above which the
+            database is vacuumed
+        :return bool: Whether the database was vacuumed
+        """
+        self.conn.commit()
+        self._commit_pending = False
+        self.cursor.execute('pragma page_count')
+        page_count = self.cursor.fetchone()[0]
+        self.cursor.execute('pragma freelist_count')
+        free = self.cursor.fetchone()[0]
+        if not page_count or float(free) / page_count < min_free_ratio:
+            return False
+        self.cursor.execute('vacuum')
+        self.cursor.execute('pragma wal_checkpoint(truncate)')
+        return True
 
     def _init(self):
+        # WAL needs no fsync of the database file on every commit, and only
+        # syncs the log at checkpoints when synchronous is NORMAL.
+        self.cursor.execute('pragma journal_mode=wal')
+        self.cursor.execute('pragma synchronous=normal')
         self.cursor.execute('''
             create table if not exists kv (
                key text,
@@ -415,6 +531,22 @@ class Storage(object):
         pprint.pprint(self.cursor.fetchall(), stream=fh)
 
 
+def _prefix_range(prefix):
+    """Returns a where clause and params matching keys starting with prefix.
+
+    Unlike LIKE, a range comparison can use the primary key index.
+    """
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode('utf-8')
+    upper = prefix
+    while upper and ord(upper[-1]) == sys.maxunicode:
+        upper = upper[:-1]
+    if not upper:
+        return 'key >= ?', [prefix]
+    upper = upper[:-1] + _unichr(ord(upper[-1]) + 1)
+    return 'key >= ? and key < ?', [prefix, upper]
+
+
 def _parse_history(d):
     return (d[0], d[1], json.loads(d[2]), d[3],
             datetime.datetime.strptime(d[-1], "%Y-%m-%dT%H:%M:%S.%f"))
@@ -509,10 +641,64 @@ Delta = collections.namedtuple('Delta', ['previous', 'current'])
 
 
 _KV = None
+_DEFER_COMMITS = False
 
 
 def kv():
     global _KV
     if _KV is None:
         _KV = Storage()
+        if _DEFER_COMMITS:
+            _KV.defer_commits()
     return _KV
+
+
+def defer_commits():
+    """Defer commits of the unit kv store to process exit.
+
+    See :meth:`Storage.defer_commits`. The store is not opened until it is
+    first used.
+    """
+    global _DEFER_COMMITS
+    _DEFER_COMMITS = True
+    if _KV is not None:
+        _KV.defer_commits()
+
+
+def _benchmark(count=2000, path=None):
+    """Microbenchmark of set/get/update throughput.
+
+    Run as ``python -m charmhelpers.core.unitdata [count]``.
+    """
+    import tempfile
+    import time
+
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    results = collections.OrderedDict()
+
+    def timed(name, func):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        results[name] = count / elapsed if elapsed else float('inf')
+
+    db = Storage(path)
+    timed('set', lambda: [db.set('set.%d' % i, i) for i in range(count)])
+    timed('set+flush', lambda: [(db.set('flush.%d' % i, i), db.flush())
+                                for i in range(count)])
+    timed('get', lambda: [db.get('set.%d' % i) for i in range(count)])
+    timed('update', lambda: db.update(
+        dict(('%d' % i, i) for i in range(count)), prefix='update.'))
+    db.defer_commits()
+    timed('set+flush (deferred)', lambda: [
+        (db.set('deferred.%d' % i, i), db.flush()) for i in range(count)])
+    db.close()
+
+    for name, rate in results.items():
+        print('%-22s %12.0f ops/s' % (name, rate))
+    return results
+
+
+if __name__ == '__main__':
+    _benchmark(*[int(a) for a in sys.argv[1:2]])
@@ -101,6 +101,11 @@ if __platform__ == "ubuntu":
     apt_unhold = fetch.apt_unhold
     import_key = fetch.import_key
     get_upstream_version = fetch.get_upstream_version
+    get_installed_version = fetch.get_installed_version
+    dpkg_status_index = fetch.dpkg_status_index
+    invalidate_apt_cache = fetch.invalidate_apt_cache
+    upstream_version = fetch.upstream_version
+    DPKG_STATUS = fetch.DPKG_STATUS
 elif __platform__ == "centos":
     yum_search = fetch.yum_search
 
@@ -164,29 +164,121 @@ CMD_RETRY_DELAY = 10  # Wait 10 seconds between command retries.
 CMD_RETRY_COUNT = 3  # Retry a failing fatal command X times.
 
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+# dpkg states in which apt reports a current version for a package.
+DPKG_NOT_INSTALLED_STATES = ('not-installed', 'config-files')
+
+_apt_cache = None
+_dpkg_index = None
+
+
 def filter_installed_packages(packages):
     """Return a list of packages that require installation."""
-    cache = apt_cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
-    return _pkgs
+    index = dpkg_status_index()
+    if index is None:
+        cache = apt_cache()
+        _pkgs = []
+        for package in packages:
+            try:
+                p = cache[package]
+                p.current_ver or _pkgs.append(package)
+            except KeyError:
+                log('Package {} has no installation candidate.'
+                    .format(package), level='WARNING')
+                _pkgs.append(package)
+        return _pkgs
+    return [package for package in packages if not index.get(package)]
 
 
 def apt_cache(in_memory=True, progress=None):
-    """Build and return an apt cache."""
+    """Build and return an apt cache.
+
+    The in-memory cache is built once per process and shared by subsequent
+    callers; it is discarded by invalidate_apt_cache() after apt has changed
+    the package state.  Passing a progress object always builds a fresh
+    cache.
+    """
+    global _apt_cache
+    if in_memory and progress is None and _apt_cache is not None:
+        return _apt_cache
     from apt import apt_pkg
     apt_pkg.init()
     if in_memory:
         apt_pkg.config.set("Dir::Cache::pkgcache", "")
         apt_pkg.config.set("Dir::Cache::srcpkgcache", "")
-    return apt_pkg.Cache(progress)
+    cache = apt_pkg.Cache(progress)
+    if in_memory and progress is None:
+        _apt_cache = cache
+    return cache
+
+
+def dpkg_status_index():
+    """Return a dict of package name to installed version from dpkg status.
+
+    Packages dpkg knows about but which have no installed version map to
+    None.  The index is read once per process and is much cheaper to build
+    than a full apt cache.  Returns None if the dpkg status file cannot be
+    read.
+    """
+    global _dpkg_index
+    if _dpkg_index is not None:
+        return _dpkg_index
+    try:
+        with open(DPKG_STATUS) as status:
+            content = status.read()
+    except (IOError, OSError):
+        return None
+    index = {}
+    for stanza in content.split('\n\n'):
+        fields = {}
+        for line in stanza.splitlines():
+            if not line or line[0].isspace() or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            if key in ('Package', 'Status', 'Version'):
+                fields[key] = value.strip()
+        name = fields.get('Package')
+        if not name:
+            continue
+        state = fields.get('Status', '').split()
+        if state and state[-1] not in DPKG_NOT_INSTALLED_STATES:
+            index[name] = fields.get('Version')
+        else:
+            index.setdefault(name, None)
+    _dpkg_index = index
+    return _dpkg_index
+
+
+def get_installed_version(package):
+    """Return the installed version string of package, or None."""
+    index = dpkg_status_index()
+    if index is None:
+        try:
+            pkg = apt_cache()[package]
+        except KeyError:
+            return None
+        return pkg.current_ver.ver_str if pkg.current_ver else None
+    return index.get(package)
+
+
+def invalidate_apt_cache(index=True):
+    """Discard the shared apt cache and, optionally, the dpkg status index.
+
+    :param index: bool: Also discard the dpkg status index.  Only needed when
+        the set of installed packages may have changed.
+    """
+    global _apt_cache, _dpkg_index
+    _apt_cache = None
+    if index:
+        _dpkg_index = None
+
+
+def upstream_version(version):
+    """Strip the epoch and Debian revision from a package version string."""
+    version = version.split(':', 1)[-1]
+    if '-' in version:
+        version = version.rsplit('-', 1)[0]
+    return version
 
 
 def apt_install(packages, options=None, fatal=False):
@@ -204,6 +296,7 @@ def apt_install(packages, options=None, fatal=False):
     log("Installing {} with options: {}".format(packages,
                                                 options))
     _run_apt_command(cmd, fatal)
+    invalidate_apt_cache()
 
 
 def apt_upgrade(options=None, fatal=False, dist=False):
@@ -219,12 +312,14 @@ def apt_upgrade(options=None, fatal=False, dist=False):
         cmd.append('upgrade')
     log("Upgrading with options: {}".format(options))
     _run_apt_command(cmd, fatal)
+    invalidate_apt_cache()
 
 
 def apt_update(fatal=False):
     """Update local apt cache."""
     cmd = ['apt-get', 'update']
     _run_apt_command(cmd, fatal)
+    invalidate_apt_cache(index=False)
 
 
 def apt_purge(packages, fatal=False):
@@ -236,6 +331,7 @@ def apt_purge(packages, fatal=False):
         cmd.extend(packages)
     log("Purging {}".format(packages))
     _run_apt_command(cmd, fatal)
+    invalidate_apt_cache()
 
 
 def apt_mark(packages, mark, fatal=False):
@@ -554,16 +650,7 @@ def get_upstream_version(package):
 
     @returns None (if not installed) or the upstream version
     """
-    import apt_pkg
-    cache = apt_cache()
-    try:
-        pkg = cache[package]
-    except:
-        # the package is unknown to the current apt cache.
+    version = get_installed_version(package)
+    if not version:
         return None
-
-    if not pkg.current_ver:
-        # package is known, but no version is currently installed.
-        return None
-
-    return apt_pkg.upstream_version(pkg.current_ver.ver_str)
+    return upstream_version(version)
@@ -23,14 +23,20 @@ from subprocess import (
 from charmhelpers.core.hookenv import (
     Hooks,
     UnregisteredHookError,
+    atexit,
+    buffer_log,
     config,
     is_relation_made,
+    load_relation_snapshot,
     local_unit,
     log,
     ERROR,
+    INFO,
+    queue_relation_set,
     relation_get,
     relation_ids,
     relation_set,
+    set_log_level,
     status_set,
     open_port,
     unit_get,
@@ -39,10 +45,13 @@ from charmhelpers.core.hookenv import (
 
 from charmhelpers.core.host import (
     mkdir,
+    queue_restarts,
     service_reload,
     service_restart,
 )
 
+from charmhelpers.core.unitdata import defer_commits
+
 from charmhelpers.fetch import (
     apt_install,
     add_source,
@@ -67,21 +76,29 @@ from neutron_api_utils import (
     additional_install_locations,
     API_PASTE_INI,
     api_port,
+    api_ready_gate,
     assess_status,
     CLUSTER_RES,
+    compact_unit_state,
     determine_packages,
     determine_ports,
     do_openstack_upgrade,
     dvr_router_present,
     force_etcd_restart,
+    gate_api_ready,
     get_topics,
     git_install,
     is_api_ready,
     l3ha_router_present,
+    LazyConfigs,
     migrate_neutron_database,
     NEUTRON_CONF,
     neutron_ready,
+    package_plan_changed,
+    record_package_plan,
     register_configs,
+    RESTART_ORDER,
+    restart_functions,
     restart_map,
     services,
     setup_ipv6,
@@ -129,7 +146,7 @@ from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.contrib.hardening.harden import harden
 
 hooks = Hooks()
-CONFIGS = register_configs()
+CONFIGS = LazyConfigs(register_configs)
 
 
 def conditional_neutron_migration():
@@ -191,19 +208,23 @@ def install():
     apt_update(fatal=True)
     packages = determine_packages(openstack_origin)
     apt_install(packages, fatal=True)
+    record_package_plan(packages)
 
     status_set('maintenance', 'Git install')
     git_install(config('openstack-origin-git'))
 
     [open_port(port) for port in determine_ports()]
 
+    CONFIGS.compile_templates()
+
     if neutron_plugin == 'midonet':
         mkdir('/etc/neutron/plugins/midonet', owner='neutron', group='neutron',
               perms=0o755, force=False)
 
 
 @hooks.hook('vsd-rest-api-relation-joined')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True,
+                   restart_functions=restart_functions)
 def relation_set_nuage_cms_name(rid=None):
     if CompareOpenStackReleases(os_release('neutron-server')) >= 'kilo':
         if config('vsd-cms-name') is None:
@@ -218,7 +239,8 @@ def relation_set_nuage_cms_name(rid=None):
 
 
 @hooks.hook('vsd-rest-api-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True,
+                   restart_functions=restart_functions)
 def vsd_changed(relation_id=None, remote_unit=None):
     if config('neutron-plugin') == 'vsp':
         vsd_ip_address = relation_get('vsd-ip-address')
@@ -239,7 +261,8 @@ def vsd_changed(relation_id=None, remote_unit=None):
 
 @hooks.hook('upgrade-charm')
 @hooks.hook('config-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True,
+                   restart_functions=restart_functions)
 @harden()
 def config_changed():
     # If neutron is ready to be queried then check for incompatability between
@@ -276,10 +299,13 @@ def config_changed():
         config('neutron-plugin'),
         config('openstack-origin')
     )
-    status_set('maintenance', 'Installing apt packages')
-    apt_install(filter_installed_packages(
-                determine_packages(config('openstack-origin'))),
-                fatal=True)
+    packages = determine_packages(config('openstack-origin'))
+    if package_plan_changed(packages):
+        status_set('maintenance', 'Installing apt packages')
+        apt_install(filter_installed_packages(packages), fatal=True)
+        record_package_plan(packages)
+    # config-changed follows upgrade-charm, so pick up new templates here
+    CONFIGS.compile_templates()
     configure_https()
     update_nrpe_config()
     CONFIGS.write_all()
@@ -304,7 +330,7 @@ def amqp_joined(relation_id=None):
 
 @hooks.hook('amqp-relation-changed')
 @hooks.hook('amqp-relation-departed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map, restart_functions=restart_functions)
 def amqp_changed():
     if 'amqp' not in CONFIGS.complete_contexts():
         log('amqp relation incomplete. Peer not ready?')
@@ -355,7 +381,7 @@ def pgsql_neutron_db_joined():
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map, restart_functions=restart_functions)
 def db_changed():
     if 'shared-db' not in CONFIGS.complete_contexts():
         log('shared-db relation incomplete. Peer not ready?')
@@ -368,7 +394,7 @@ def db_changed():
 
 
 @hooks.hook('pgsql-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map, restart_functions=restart_functions)
 def postgresql_neutron_db_changed():
     CONFIGS.write(NEUTRON_CONF)
     conditional_neutron_migration()
@@ -412,7 +438,7 @@ def identity_joined(rid=None, relation_trigger=False):
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map, restart_functions=restart_functions)
 def identity_changed():
     if 'identity-service' not in CONFIGS.complete_contexts():
         log('identity-service relation incomplete. Peer not ready?')
@@ -443,6 +469,7 @@ def neutron_api_relation_joined(rid=None):
 
     if is_api_ready(CONFIGS):
         relation_data['neutron-api-ready'] = "yes"
+        gate_api_ready()
     else:
         relation_data['neutron-api-ready'] = "no"
 
@@ -454,7 +481,7 @@ def neutron_api_relation_joined(rid=None):
 
 
 @hooks.hook('neutron-api-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map, restart_functions=restart_functions)
 def neutron_api_relation_changed():
     CONFIGS.write(NEUTRON_CONF)
 
@@ -512,6 +539,7 @@ def neutron_plugin_api_relation_joined(rid=None):
 
     if is_api_ready(CONFIGS):
         relation_data['neutron-api-ready'] = "yes"
+        gate_api_ready()
     else:
         relation_data['neutron-api-ready'] = "no"
 
@@ -536,7 +564,8 @@ def cluster_joined(relation_id=None):
 
 @hooks.hook('cluster-relation-changed',
             'cluster-relation-departed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True,
+                   restart_functions=restart_functions)
 def cluster_changed():
     CONFIGS.write_all()
 
@@ -624,7 +653,8 @@ def zeromq_configuration_relation_joined(relid=None):
 
 @hooks.hook('neutron-plugin-api-subordinate-relation-joined',
             'neutron-plugin-api-subordinate-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True,
+                   restart_functions=restart_functions)
 def neutron_plugin_api_subordinate_relation_joined(relid=None):
     '''
     -changed handles relation data set by a subordinate.
@@ -632,6 +662,7 @@ def neutron_plugin_api_subordinate_relation_joined(relid=None):
     relation_data = {'neutron-api-ready': 'no'}
     if is_api_ready(CONFIGS):
         relation_data['neutron-api-ready'] = "yes"
+        gate_api_ready()
     relation_set(relation_id=relid, **relation_data)
 
     # there is no race condition with the neutron service restart
@@ -642,7 +673,8 @@ def neutron_plugin_api_subordinate_relation_joined(relid=None):
 
 @hooks.hook('zeromq-configuration-relation-changed',
             'neutron-plugin-api-subordinate-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True,
+                   restart_functions=restart_functions)
 def zeromq_configuration_relation_changed():
     CONFIGS.write_all()
 
@@ -651,7 +683,8 @@ def zeromq_configuration_relation_changed():
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
     # python-dbus is used by check_upstart_job
-    apt_install('python-dbus')
+    if filter_installed_packages(['python-dbus']):
+        apt_install('python-dbus')
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
@@ -681,7 +714,7 @@ def etcd_proxy_force_restart(relation_id=None):
 @hooks.hook('midonet-relation-joined')
 @hooks.hook('midonet-relation-changed')
 @hooks.hook('midonet-relation-departed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map, restart_functions=restart_functions)
 def midonet_changed():
     CONFIGS.write_all()
 
@@ -691,9 +724,18 @@ def midonet_changed():
 @harden()
 def update_status():
     log('Updating status.')
+    compact_unit_state()
 
 
 def main():
+    buffer_log()
+    if not config('debug'):
+        set_log_level(INFO)
+    load_relation_snapshot()
+    queue_relation_set()
+    atexit(api_ready_gate)
+    queue_restarts(order=RESTART_ORDER)
+    defer_commits()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
@@ -17,9 +17,13 @@ from copy import deepcopy
 from functools import partial
 import os
 import shutil
+import socket
 import subprocess
 import glob
+import time
 from base64 import b64encode
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.request import urlopen
 from charmhelpers.contrib.openstack import context, templating
 from charmhelpers.contrib.openstack.neutron import (
     neutron_plugin_attribute,
@@ -52,17 +56,21 @@ from charmhelpers.contrib.python.packages import (
 )
 
 from charmhelpers.core.hookenv import (
+    cached,
     charm_dir,
     config,
     log,
     relation_ids,
+    DEBUG,
+    WARNING,
 )
 
 from charmhelpers.fetch import (
     apt_update,
     apt_install,
     apt_upgrade,
-    add_source
+    add_source,
+    get_installed_version,
 )
 
 from charmhelpers.core.host import (
@@ -72,6 +80,8 @@ from charmhelpers.core.host import (
     add_user_to_group,
     CompareHostReleases,
     mkdir,
+    path_hash,
+    service_reload,
     service_stop,
     service_start,
     service_restart,
@@ -79,10 +89,17 @@ from charmhelpers.core.host import (
 )
 
 from charmhelpers.contrib.hahelpers.cluster import (
+    determine_api_port,
     get_hacluster_config,
 )
 
+from charmhelpers.contrib.network.ip import (
+    format_ipv6_addr,
+    wait_for_listeners,
+)
+
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.templating import render
 from charmhelpers.contrib.hahelpers.cluster import is_elected_leader
 
@@ -111,6 +128,27 @@ KILO_PACKAGES = [
 
 VERSION_PACKAGE = 'neutron-common'
 
+# apt sources and keyrings whose contents make up the package plan
+APT_STATE_PATHS = [
+    '/etc/apt/sources.list',
+    '/etc/apt/sources.list.d/*',
+    '/etc/apt/trusted.gpg',
+    '/etc/apt/trusted.gpg.d/*',
+]
+
+PACKAGE_PLAN_KEY = 'neutron-api.package-plan'
+
+# hook history kept in the unit kv store
+UNIT_STATE_KEEP_REVISIONS = 100
+UNIT_STATE_KEEP_DAYS = 30
+
+# readiness gate run before neutron-api-ready is published
+API_READY_KEY = 'neutron-api.api-ready-wait'
+API_READY_TIMEOUT = 60
+API_READY_INITIAL_DELAY = 0.5
+API_READY_MAX_DELAY = 8
+API_READY_REQUEST_TIMEOUT = 5
+
 BASE_GIT_PACKAGES = [
     'libffi-dev',
     'libmysqlclient-dev',
@@ -211,6 +249,23 @@ BASE_RESOURCE_MAP = OrderedDict([
     }),
 ])
 
+# How each service picks up a change to its configuration files. haproxy
+# reloads seamlessly and apache2 gracefully, so in-flight API requests are
+# not dropped; services not listed here (neutron-server) are restarted, or
+# stopped and started, as requested by restart_on_change.
+RESTART_POLICY = {
+    'haproxy': 'reload',
+    'apache2': 'reload',
+}
+
+# Services which must be restarted before another when both are restarted
+# in the same hook; services with no ordering between them are restarted
+# concurrently.
+RESTART_ORDER = {
+    'neutron-server': ['memcached'],
+    'haproxy': ['neutron-server'],
+}
+
 # The interface is said to be satisfied if anyone of the interfaces in the
 # list has a complete context.
 REQUIRED_INTERFACES = {
@@ -289,8 +344,57 @@ def additional_install_locations(plugin, source):
             add_source('deb http://repo.midonet.org/midonet/v%s stable main' %
                        release_num, key=pub_gpg_key)
 
-        apt_update(fatal=True)
-        apt_upgrade(fatal=True)
+        if package_plan_changed():
+            apt_update(fatal=True)
+            apt_upgrade(fatal=True)
+
+
+def package_plan(packages=None):
+    '''
+    Return the desired apt state: a digest of every apt source list and
+    keyring and, if packages is supplied, the installed version of each
+    package.
+    '''
+    sources = {}
+    for path in APT_STATE_PATHS:
+        sources.update(path_hash(path))
+    plan = {'sources': sources}
+    if packages is not None:
+        plan['packages'] = {p: get_installed_version(p)
+                            for p in sorted(set(packages))}
+    return plan
+
+
+def package_plan_changed(packages=None):
+    '''
+    Determine whether the apt state differs from the last applied plan.
+
+    Only the parts of the plan covered by the arguments are compared, so
+    calling without packages checks the apt sources and keys alone.
+    '''
+    applied = unitdata.kv().get(PACKAGE_PLAN_KEY) or {}
+    plan = package_plan(packages)
+    return any(plan[k] != applied.get(k) for k in plan)
+
+
+def record_package_plan(packages):
+    '''Persist the current apt state as the last applied package plan.'''
+    db = unitdata.kv()
+    db.set(PACKAGE_PLAN_KEY, package_plan(packages))
+    db.flush()
+
+
+def compact_unit_state(revisions=UNIT_STATE_KEEP_REVISIONS,
+                       days=UNIT_STATE_KEEP_DAYS):
+    '''
+    Drop unit kv store hook history beyond the last revisions hooks or older
+    than days days, and vacuum the store if that freed enough space.
+    '''
+    db = unitdata.kv()
+    pruned = db.prune(revisions=revisions, days=days)
+    if db.compact():
+        log('Compacted unit state after pruning %d rows' % pruned,
+            level=DEBUG)
 
 
 def force_etcd_restart():
@@ -367,22 +471,46 @@ def resource_map(release=None):
     '''
     Dynamically generate a map of resources that will be managed for a single
     hook execution.
+
+    The map is only built once per distinct combination of the inputs which
+    affect it; callers get a shallow copy that shares the context instances,
+    so it must be treated as read-only.
     '''
     release = release or os_release('neutron-common')
+    _map = _build_resource_map(
+        release,
+        config('neutron-plugin'),
+        manage_plugin(),
+        config('enable-sriov'),
+        enable_memcache(release=release),
+        os.path.exists('/etc/apache2/conf-available'),
+        config('database'))
+    return OrderedDict([(cfg, {'services': list(rscs['services']),
+                               'contexts': list(rscs['contexts'])})
+                        for cfg, rscs in _map.iteritems()])
+
+
+@cached
+def _build_resource_map(release, plugin, legacy_mode, sriov, memcache,
+                        apache24, database):
+    '''
+    Build the resource map for a set of inputs.
 
+    Memoized via hookenv.cached, so any change to release or to the config
+    options passed in produces a fresh map rather than a stale one.
+    '''
     resource_map = deepcopy(BASE_RESOURCE_MAP)
     if CompareOpenStackReleases(release) >= 'liberty':
         resource_map.update(LIBERTY_RESOURCE_MAP)
 
-    if os.path.exists('/etc/apache2/conf-available'):
+    if apache24:
         resource_map.pop(APACHE_CONF)
     else:
         resource_map.pop(APACHE_24_CONF)
 
-    if manage_plugin():
+    if legacy_mode:
         # add neutron plugin requirements. nova-c-c only needs the
         # neutron-server associated with configs, not the plugin agent.
-        plugin = config('neutron-plugin')
         conf = neutron_plugin_attribute(plugin, 'config', 'neutron')
         ctxts = (neutron_plugin_attribute(plugin, 'contexts', 'neutron') or
                  [])
@@ -396,10 +524,10 @@ def resource_map(release=None):
 
         # update for postgres
         resource_map[conf]['contexts'].append(
-            context.PostgresqlDBContext(database=config('database')))
+            context.PostgresqlDBContext(database=database))
 
         if ('kilo' <= CompareOpenStackReleases(release) <= 'mitaka' and
-                config('enable-sriov')):
+                sriov):
             resource_map[ML2_SRIOV_INI] = {}
             resource_map[ML2_SRIOV_INI]['services'] = services
             resource_map[ML2_SRIOV_INI]['contexts'] = []
@@ -409,7 +537,7 @@ def resource_map(release=None):
         )
         resource_map[NEUTRON_DEFAULT]['contexts'] = \
             [neutron_api_context.NeutronApiSDNConfigFileContext()]
-    if enable_memcache(release=release):
+    if memcache:
         resource_map[MEMCACHED_CONF] = {
             'contexts': [context.MemcacheContext()],
             'services': ['memcached']}
@@ -426,12 +554,44 @@ def register_configs(release=None):
     return configs
 
 
+class LazyConfigs(object):
+    '''
+    Stands in for the OSConfigRenderer built by factory, which is only called
+    the first time the renderer is used. Building it at import time would
+    register every config file, and resolve the release, before main() has
+    set up log buffering and the relation snapshot.
+    '''
+    def __init__(self, factory):
+        self._factory = factory
+        self._configs = None
+
+    def __getattr__(self, name):
+        if self._configs is None:
+            self._configs = self._factory()
+        return getattr(self._configs, name)
+
+
 def restart_map():
     return OrderedDict([(cfg, v['services'])
                         for cfg, v in resource_map().iteritems()
                         if v['services']])
 
 
+def reload_or_restart(service_name):
+    '''Reload service_name, falling back to a restart if the reload fails.'''
+    return service_reload(service_name, restart_on_failure=True)
+
+
+def restart_functions():
+    '''
+    Returns the {service: function} map used by restart_on_change for
+    services whose RESTART_POLICY is not the default restart (or stop/start).
+    '''
+    return {svc: reload_or_restart
+            for svc, policy in RESTART_POLICY.iteritems()
+            if policy == 'reload'}
+
+
 def services():
     ''' Returns a list of services associate with this charm '''
     _services = []
@@ -763,6 +923,87 @@ def is_api_ready(configs):
     return (not incomplete_relation_data(configs, REQUIRED_INTERFACES))
 
 
+_api_ready_published = []
+
+
+def gate_api_ready():
+    '''
+    Note that this hook is publishing neutron-api-ready, so that
+    api_ready_gate() waits for the API before the relation data goes out.
+    '''
+    if not _api_ready_published:
+        _api_ready_published.append(True)
+
+
+def api_ready_gate():
+    '''
+    Wait for the API if gate_api_ready() was called during this hook.
+
+    Registered with hookenv.atexit so that it runs after any queued service
+    restarts and before queued relation data is published.
+    '''
+    if not _api_ready_published or is_unit_paused_set():
+        return
+    del _api_ready_published[:]
+    wait_for_api_ready()
+
+
+def _api_responding(host, port):
+    '''
+    Returns True if neutron-server answers an HTTP GET of / on host:port.
+    '''
+    url = 'http://%s:%s/' % (format_ipv6_addr(host) or host, port)
+    try:
+        urlopen(url, timeout=API_READY_REQUEST_TIMEOUT).close()
+    except HTTPError:
+        # Any HTTP response, e.g. 401 without a token, means it is serving
+        pass
+    except (URLError, socket.error):
+        return False
+    return True
+
+
+def wait_for_api_ready(timeout=API_READY_TIMEOUT):
+    '''
+    Wait, with exponential backoff, for up to timeout seconds for the haproxy
+    frontend and neutron-server to listen and then for neutron-server to
+    answer HTTP. How long that took is recorded in the unit kv store.
+
+    :returns: True if the API answered in time.
+    '''
+    start = time.time()
+    deadline = start + timeout
+    host = '::1' if config('prefer-ipv6') else '127.0.0.1'
+    bind_port = determine_api_port(api_port('neutron-server'),
+                                   singlenode_mode=True)
+    ready = wait_for_listeners(host, [api_port('neutron-server'), bind_port],
+                               timeout=timeout,
+                               interval=API_READY_INITIAL_DELAY,
+                               backoff=2,
+                               max_interval=API_READY_MAX_DELAY)
+    # neutron-server often listens a while before it can answer requests.
+    delay = API_READY_INITIAL_DELAY
+    while ready and not _api_responding(host, bind_port):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            ready = False
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, API_READY_MAX_DELAY)
+    elapsed = time.time() - start
+
+    if ready:
+        log('neutron-server ready after %.1fs' % elapsed, level=DEBUG)
+    else:
+        log('neutron-server not ready after %.1fs' % elapsed, level=WARNING)
+    db = unitdata.kv()
+    db.set(API_READY_KEY, {'ready': ready,
+                           'elapsed': round(elapsed, 3),
+                           'timestamp': start})
+    db.flush()
+    return ready
+
+
 def assess_status(configs):
     """Assess status of current unit
     Decides what the state of the unit should be based on the current
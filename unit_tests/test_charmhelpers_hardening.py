@@ -0,0 +1,297 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grp
+import os
+import pwd
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+# python-apt is not installed as part of test-requirements but is imported by
+# some charmhelpers modules so create a fake import.
+sys.modules['apt'] = MagicMock()
+
+import charmhelpers.contrib.hardening.audits as audits  # noqa: E402
+import charmhelpers.contrib.hardening.audits.file as file_audits  # noqa: E402
+from charmhelpers.contrib.hardening.host.checks import suid_sgid  # noqa: E402
+from charmhelpers.core import unitdata  # noqa: E402
+
+
+class RaisingAudit(audits.BaseAudit):
+
+    def ensure_compliance(self):
+        raise ValueError('audit failed')
+
+
+class RecordingAudit(audits.BaseAudit):
+
+    def __init__(self, ran, *args, **kwargs):
+        super(RecordingAudit, self).__init__(*args, **kwargs)
+        self.ran = ran
+
+    def ensure_compliance(self):
+        self.ran.append(self)
+
+
+class RunAuditsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(RunAuditsTestCase, self).setUp()
+        _log = patch.object(audits, 'log')
+        self.log = _log.start()
+        self.addCleanup(_log.stop)
+
+    def _run_audits(self, checks, **kwargs):
+        """Runs the audits in a separate thread so that a hang fails the
+        test instead of blocking it forever.
+        """
+        result = {}
+
+        def _run():
+            try:
+                result['value'] = audits.run_audits(checks, **kwargs)
+            except Exception as e:
+                result['error'] = e
+
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+        t.join(10)
+        self.assertFalse(t.is_alive(), 'run_audits did not return')
+        return result
+
+    def test_failing_audit_with_dependents(self):
+        ran = []
+        checks = [RaisingAudit(), RecordingAudit(ran), RecordingAudit(ran)]
+        result = self._run_audits(checks)
+        self.assertIsInstance(result.get('error'), ValueError)
+        self.assertEqual(ran, [])
+
+    def test_failing_unthreadsafe_audit_with_dependents(self):
+        ran = []
+        checks = [RaisingAudit(), RecordingAudit(ran), RecordingAudit(ran)]
+        for check in checks:
+            check.threadsafe = False
+        result = self._run_audits(checks)
+        self.assertIsInstance(result.get('error'), ValueError)
+        self.assertEqual(ran, [])
+
+    def test_run_audits(self):
+        ran = []
+        checks = [RecordingAudit(ran), RecordingAudit(ran)]
+        result = self._run_audits(checks)
+        self.assertEqual(ran, checks)
+        self.assertEqual([name for name, _ in result['value']],
+                         ['RecordingAudit', 'RecordingAudit'])
+
+    def test_run_audits_logs_summary_at_info(self):
+        self._run_audits([RecordingAudit([])])
+        levels = [c[1].get('level') for c in self.log.call_args_list]
+        self.assertIn(audits.INFO, levels)
+
+
+class CompliantAudit(audits.BaseAudit):
+
+    def __init__(self, paths=None, *args, **kwargs):
+        super(CompliantAudit, self).__init__(*args, **kwargs)
+        self.paths = paths
+
+    def fingerprint_paths(self):
+        return self.paths
+
+    def compliant(self):
+        return True
+
+
+class AuditPassTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(AuditPassTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db = unitdata.Storage(os.path.join(self.tmpdir, 'state.db'))
+        self.addCleanup(self.db.close)
+        for method in ('log', 'unitdata', 'hook_name'):
+            _m = patch.object(audits, method)
+            setattr(self, method, _m.start())
+            self.addCleanup(_m.stop)
+        self.unitdata.kv.return_value = self.db
+        self.hook_name.return_value = 'update-status'
+        self.addCleanup(audits._audit_pass.clear)
+        self.path = os.path.join(self.tmpdir, 'a.conf')
+        open(self.path, 'w').close()
+        _m = patch.object(CompliantAudit, 'ensure_compliance')
+        self.ensure_compliance = _m.start()
+        self.addCleanup(_m.stop)
+
+    def _audit_pass(self, checks):
+        audits.start_audit_pass()
+        audits.run_audits(checks, threads=1)
+        audits.finish_audit_pass()
+
+    def test_unchanged_audit_skipped(self):
+        check = CompliantAudit(paths=[self.path])
+        self._audit_pass([check])
+        self._audit_pass([check])
+        self.assertEqual(self.ensure_compliance.call_count, 1)
+        os.chmod(self.path, 0o600)
+        self._audit_pass([check])
+        self.assertEqual(self.ensure_compliance.call_count, 2)
+
+    def test_audit_without_paths_not_skipped(self):
+        check = CompliantAudit()
+        self._audit_pass([check])
+        self._audit_pass([check])
+        self.assertEqual(self.ensure_compliance.call_count, 2)
+        self.assertEqual(self.db.get(audits.AUDIT_FINGERPRINTS_KEY), {})
+
+    def test_non_compliant_audit_not_skipped(self):
+        check = CompliantAudit(paths=[self.path])
+        check.compliant = lambda: False
+        self._audit_pass([check])
+        self._audit_pass([check])
+        self.assertEqual(self.ensure_compliance.call_count, 2)
+
+    def test_directory_audit_fingerprint(self):
+        user = pwd.getpwuid(os.getuid()).pw_name
+        group = grp.getgrgid(os.getgid()).gr_name
+        recursive = file_audits.DirectoryPermissionAudit(
+            self.tmpdir, user, group)
+        self.assertIsNone(recursive.fingerprint_paths())
+        flat = file_audits.DirectoryPermissionAudit(
+            self.tmpdir, user, group, recursive=False)
+        self.assertEqual(flat.fingerprint_paths(), [self.tmpdir])
+
+
+class DirectoryPermissionAuditTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(DirectoryPermissionAuditTestCase, self).setUp()
+        _log = patch.object(file_audits.utils, 'log')
+        _log.start()
+        self.addCleanup(_log.stop)
+        self.user = pwd.getpwuid(os.getuid()).pw_name
+        self.group = grp.getgrgid(os.getgid()).gr_name
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _mode(self, path):
+        return os.stat(path).st_mode & 0o7777
+
+    def _mkfile(self, path, mode=0o644):
+        open(path, 'w').close()
+        os.chmod(path, mode)
+        return path
+
+    def test_comply_tree(self):
+        subdir = os.path.join(self.tmpdir, 'sub')
+        os.mkdir(subdir, 0o755)
+        files = [self._mkfile(os.path.join(self.tmpdir, 'a.conf')),
+                 self._mkfile(os.path.join(subdir, 'b.conf'))]
+        for recursive in (True, False):
+            os.chmod(self.tmpdir, 0o755)
+            os.chmod(subdir, 0o755)
+            for path in files:
+                os.chmod(path, 0o644)
+            audit = file_audits.DirectoryPermissionAudit(
+                self.tmpdir, self.user, self.group, mode=0o750,
+                recursive=recursive)
+            self.assertEqual(audit.comply(self.tmpdir), 4)
+            for path in [self.tmpdir, subdir] + files:
+                self.assertEqual(self._mode(path), 0o750)
+            # Compliant paths are not changed again.
+            self.assertEqual(audit.comply(self.tmpdir), 0)
+
+    def test_comply_without_subdirectories(self):
+        os.chmod(self.tmpdir, 0o755)
+        path = self._mkfile(os.path.join(self.tmpdir, 'a.conf'))
+        audit = file_audits.DirectoryPermissionAudit(
+            self.tmpdir, self.user, self.group, mode=0o750)
+        self.assertEqual(audit.comply(self.tmpdir), 0)
+        self.assertEqual(self._mode(self.tmpdir), 0o755)
+        self.assertEqual(self._mode(path), 0o644)
+
+
+class SUIDSGIDScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(SUIDSGIDScanTestCase, self).setUp()
+        _log = patch.object(suid_sgid, 'log')
+        _log.start()
+        self.addCleanup(_log.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.root = os.path.join(self.tmpdir, 'root')
+        self.index = os.path.join(self.tmpdir, 'index.json.gz')
+        os.makedirs(os.path.join(self.root, 'bin'))
+        os.makedirs(os.path.join(self.root, 'mail'))
+
+    def _mkfile(self, path, mode):
+        path = os.path.join(self.root, path)
+        open(path, 'w').close()
+        os.chmod(path, mode)
+        return path
+
+    def _find(self, **kwargs):
+        return suid_sgid.find_paths_with_suid_sgid(
+            self.root, index_path=self.index, threads=2, **kwargs)
+
+    def test_find_regular_files_only(self):
+        suid = self._mkfile('bin/su', 0o4755)
+        sgid = self._mkfile('bin/wall', 0o2755)
+        self._mkfile('bin/ls', 0o755)
+        # An sgid directory is a group inheritance mechanism, not reported.
+        os.chmod(os.path.join(self.root, 'mail'), 0o2775)
+        self.assertTrue(os.stat(os.path.join(self.root, 'mail')).st_mode &
+                        stat.S_ISGID)
+        self.assertEqual(self._find(), set([suid, sgid]))
+
+    def test_find_incremental(self):
+        suid = self._mkfile('bin/su', 0o4755)
+        self.assertEqual(self._find(), set([suid]))
+        self.assertTrue(os.path.exists(self.index))
+        self.assertEqual(self._find(incremental=True), set([suid]))
+        os.chmod(suid, 0o755)
+        self.assertEqual(self._find(incremental=True), set())
+        # A new file changes the directory's mtime, so it is listed again.
+        sgid = self._mkfile('mail/lock', 0o2755)
+        self.assertEqual(self._find(incremental=True), set([sgid]))
+
+    def test_find_pruned(self):
+        self._mkfile('bin/su', 0o4755)
+        sgid = self._mkfile('mail/lock', 0o2755)
+        self.assertEqual(
+            self._find(prune_paths=[os.path.join(self.root, 'bin')]),
+            set([sgid]))
+
+    def test_index_path(self):
+        with patch.dict(os.environ, {'UNIT_STATE_DB': '/srv/unit/state.db',
+                                     'CHARM_DIR': '/srv/charm'}):
+            self.assertEqual(suid_sgid._index_path(),
+                             '/srv/unit/' + suid_sgid.SUID_SGID_INDEX)
+        with patch.dict(os.environ, {'CHARM_DIR': '/srv/charm'}):
+            os.environ.pop('UNIT_STATE_DB', None)
+            self.assertEqual(suid_sgid._index_path(),
+                             '/srv/charm/' + suid_sgid.SUID_SGID_INDEX)
+        with patch.dict(os.environ, {}):
+            os.environ.pop('UNIT_STATE_DB', None)
+            os.environ.pop('CHARM_DIR', None)
+            self.assertEqual(suid_sgid._index_path(), os.path.join(
+                suid_sgid.SUID_SGID_STATE_DIR, suid_sgid.SUID_SGID_INDEX))
@@ -0,0 +1,151 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import os
+import unittest
+
+from mock import patch
+
+import charmhelpers.core.hookenv as hookenv
+
+RELATIONS = {
+    'amqp': {
+        'amqp:1': {
+            'rabbitmq-server/0': {'password': 'secret', 'hostname': 'rmq0'},
+            'neutron-api/0': {'username': 'neutron'},
+        },
+    },
+    'shared-db': {
+        'shared-db:2': {
+            'mysql/0': {'db_host': 'db0'},
+        },
+    },
+}
+
+
+class RelationSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(RelationSnapshotTestCase, self).setUp()
+        self.relations = copy.deepcopy(RELATIONS)
+        self.rids = dict((rid, units)
+                         for rids in self.relations.values()
+                         for rid, units in rids.items())
+        fakes = {
+            '_relation_ids': lambda reltype: sorted(
+                self.relations.get(reltype, {})),
+            '_related_units': lambda relid: sorted(
+                u for u in self.rids[relid] if u != 'neutron-api/0'),
+            '_relation_get': self._relation_get,
+            '_relation_set': self._relation_set,
+            'relation_types': lambda: sorted(self.relations),
+        }
+        for name, fake in fakes.items():
+            _m = patch.object(hookenv, name, side_effect=fake)
+            setattr(self, name, _m.start())
+            self.addCleanup(_m.stop)
+        _m = patch.dict(os.environ, {'JUJU_UNIT_NAME': 'neutron-api/0',
+                                     'JUJU_RELATION_ID': 'amqp:1',
+                                     'JUJU_REMOTE_UNIT': 'rabbitmq-server/0'})
+        _m.start()
+        self.addCleanup(_m.stop)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(hookenv._relation_snapshot.clear)
+        self.addCleanup(setattr, hookenv, '_relation_set_queue', None)
+
+    def _relation_get(self, attribute=None, unit=None, rid=None):
+        data = self.rids[rid].get(unit)
+        if data is None:
+            return None
+        if attribute is None:
+            return dict(data)
+        return data.get(attribute)
+
+    def _relation_set(self, relation_id, settings):
+        data = self.rids[relation_id or 'amqp:1']['neutron-api/0']
+        for key, value in settings.items():
+            if value is None or value == '':
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+    def test_load_is_lazy(self):
+        hookenv.load_relation_snapshot()
+        self.assertTrue(hookenv._relation_snapshot.loaded)
+        for fake in (self._relation_ids, self._related_units,
+                     self._relation_get, self.relation_types):
+            self.assertFalse(fake.called)
+
+    def test_lookups_cached(self):
+        hookenv.load_relation_snapshot()
+        for _ in range(2):
+            hookenv.cache.clear()
+            self.assertEqual(hookenv.relation_ids('amqp'), ['amqp:1'])
+            self.assertEqual(hookenv.related_units('amqp:1'),
+                             ['rabbitmq-server/0'])
+            self.assertEqual(
+                hookenv.relation_get('password', 'rabbitmq-server/0',
+                                     'amqp:1'), 'secret')
+            self.assertEqual(
+                hookenv.relation_get('hostname', 'rabbitmq-server/0',
+                                     'amqp:1'), 'rmq0')
+            self.assertEqual(hookenv.relation_get()['hostname'], 'rmq0')
+        self.assertEqual(self._relation_ids.call_count, 1)
+        self.assertEqual(self._related_units.call_count, 1)
+        # One full databag fetch serves every attribute.
+        self._relation_get.assert_called_once_with(
+            unit='rabbitmq-server/0', rid='amqp:1')
+        self.assertFalse(hookenv._relation_snapshot.relation_ids(
+            'shared-db') is hookenv.MARKER)
+        self.assertEqual(self._relation_ids.call_count, 2)
+
+    def test_not_loaded(self):
+        hookenv.relation_get('password', 'rabbitmq-server/0', 'amqp:1')
+        hookenv.relation_get('hostname', 'rabbitmq-server/0', 'amqp:1')
+        self.assertEqual(self._relation_get.call_count, 2)
+
+    def test_relation_set_updates_snapshot(self):
+        hookenv.load_relation_snapshot()
+        self.assertEqual(
+            hookenv.relation_get(unit='neutron-api/0', rid='amqp:1'),
+            {'username': 'neutron'})
+        hookenv.relation_set('amqp:1', {'vhost': 'openstack',
+                                        'username': None})
+        self.assertEqual(
+            hookenv.relation_get(unit='neutron-api/0', rid='amqp:1'),
+            {'vhost': 'openstack'})
+        self.assertEqual(self._relation_get.call_count, 1)
+        self.assertEqual(self.rids['amqp:1']['neutron-api/0'],
+                         {'vhost': 'openstack'})
+
+    def test_queued_relation_set_visible(self):
+        with patch.object(hookenv, 'atexit') as atexit:
+            hookenv.queue_relation_set()
+        hookenv.load_relation_snapshot()
+        hookenv.relation_set('amqp:1', vhost='openstack')
+        hookenv.relation_set('amqp:1', vhost='neutron', username=None)
+        self.assertFalse(self._relation_set.called)
+        self.assertEqual(
+            hookenv.relation_get(unit='neutron-api/0', rid='amqp:1'),
+            {'vhost': 'neutron'})
+        atexit.assert_called_once_with(hookenv.flush_relation_set)
+        hookenv.flush_relation_set()
+        self._relation_set.assert_called_once_with(
+            'amqp:1', {'vhost': 'neutron', 'username': None})
+        hookenv.cache.clear()
+        self.assertEqual(
+            hookenv.relation_get(unit='neutron-api/0', rid='amqp:1'),
+            {'vhost': 'neutron'})
@@ -0,0 +1,142 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import threading
+import unittest
+
+from mock import patch
+
+import charmhelpers.core.host as host
+
+RESTART_ORDER = {
+    'neutron-server': ['memcached'],
+    'haproxy': ['neutron-server'],
+}
+
+
+class RestartServicesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(RestartServicesTestCase, self).setUp()
+        for method in ('log', 'service'):
+            _m = patch.object(host, method)
+            setattr(self, method, _m.start())
+            self.addCleanup(_m.stop)
+
+    def _restart_services(self, restarts, **kwargs):
+        """Runs the restarts in a separate thread so that a hang fails the
+        test instead of blocking it forever.
+        """
+        result = {}
+
+        def _run():
+            try:
+                result['value'] = host.restart_services(restarts, **kwargs)
+            except Exception as e:
+                result['error'] = e
+
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+        t.join(10)
+        self.assertFalse(t.is_alive(), 'restart_services did not return')
+        return result
+
+    def test_restart_services_ordered(self):
+        restarts = [(s, {'stopstart': False, 'restart_function': None})
+                    for s in ('haproxy', 'neutron-server', 'memcached')]
+        result = self._restart_services(restarts, order=RESTART_ORDER)
+        self.assertEqual([r[0] for r in result['value']],
+                         ['memcached', 'neutron-server', 'haproxy'])
+        self.assertEqual([c[0][1] for c in self.service.call_args_list],
+                         ['memcached', 'neutron-server', 'haproxy'])
+
+    def test_restart_services_failing_dependency(self):
+        def _service(action, service_name):
+            if service_name == 'memcached':
+                raise subprocess.CalledProcessError(124, 'timeout')
+            return True
+
+        self.service.side_effect = _service
+        restarts = [(s, {'stopstart': True, 'restart_function': None})
+                    for s in ('haproxy', 'neutron-server', 'memcached')]
+        result = self._restart_services(restarts, order=RESTART_ORDER)
+        self.assertIsInstance(result.get('error'),
+                              subprocess.CalledProcessError)
+        self.assertEqual([c[0][1] for c in self.service.call_args_list],
+                         ['memcached'])
+
+
+def reload_service(service_name):
+    return True
+
+
+class QueueRestartsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(QueueRestartsTestCase, self).setUp()
+        for method in ('atexit', '_py_atexit', 'log', 'service'):
+            _m = patch.object(host, method)
+            setattr(self, method, _m.start())
+            self.addCleanup(_m.stop)
+        self.addCleanup(setattr, host, '_restart_queue', None)
+        host.queue_restarts(order=RESTART_ORDER)
+
+    def test_queue_restarts_registers_flush(self):
+        self.atexit.assert_called_once_with(host.flush_restart_queue)
+        self.assertEqual(self._registered(), [host.flush_restart_queue])
+
+    def _registered(self):
+        return [c[0][0] for c in self._py_atexit.register.call_args_list]
+
+    def test_queued_restart_kept_when_hook_fails(self):
+        host.journal_path('/etc/haproxy/haproxy.cfg')
+        self.addCleanup(host._journalled_paths.discard,
+                        '/etc/haproxy/haproxy.cfg')
+
+        host.restart_on_change_helper(
+            lambda: host.path_changed('/etc/haproxy/haproxy.cfg'),
+            {'/etc/haproxy/haproxy.cfg': ['haproxy']})
+        self.assertFalse(self.service.called)
+        # The hook then fails, so hookenv never runs its atexit callbacks;
+        # the interpreter still runs those registered with it on exit.
+        for callback in self._registered():
+            callback()
+        self.service.assert_called_once_with('restart', 'haproxy')
+
+    def test_queue_restart_same_function(self):
+        host._queue_restart('haproxy', restart_function=reload_service)
+        host._queue_restart('haproxy', restart_function=reload_service)
+        self.assertEqual(host._restart_queue['haproxy'],
+                         {'stopstart': False,
+                          'restart_function': reload_service})
+
+    def test_queue_restart_full_restart_wins(self):
+        host._queue_restart('haproxy', restart_function=reload_service)
+        host._queue_restart('haproxy', stopstart=True)
+        self.assertEqual(host._restart_queue['haproxy'],
+                         {'stopstart': True, 'restart_function': None})
+        host._queue_restart('neutron-server')
+        host._queue_restart('neutron-server',
+                            restart_function=reload_service)
+        self.assertEqual(host._restart_queue['neutron-server'],
+                         {'stopstart': False, 'restart_function': None})
+
+    def test_queue_restart_stopstart_wins(self):
+        host._queue_restart('neutron-server')
+        host._queue_restart('neutron-server', stopstart=True)
+        host._queue_restart('neutron-server')
+        self.assertEqual(host._restart_queue['neutron-server'],
+                         {'stopstart': True, 'restart_function': None})
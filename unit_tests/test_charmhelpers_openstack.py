@@ -0,0 +1,243 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+import charmhelpers.contrib.openstack.templating as templating
+import charmhelpers.contrib.openstack.utils as openstack_utils
+import charmhelpers.core.host as host
+from charmhelpers.core import unitdata
+
+# test_neutron_api_utils replaces OSConfigRenderer with a mock on import.
+OSConfigRenderer = templating.OSConfigRenderer
+
+
+class OSReleaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(OSReleaseTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.db = unitdata.Storage(os.path.join(tmpdir, 'unit-state.db'))
+        self.addCleanup(self.db.close)
+        dpkg_status = os.path.join(tmpdir, 'status')
+        open(dpkg_status, 'w').close()
+        self.packages = {'neutron-common': 'ocata', 'nova-common': 'newton'}
+        patches = {
+            'unitdata': None,
+            'config': None,
+            'git_os_codename_install_source': None,
+            'get_os_codename_package': None,
+            'DPKG_STATUS': dpkg_status,
+        }
+        for name, new in patches.items():
+            if new is None:
+                _m = patch.object(openstack_utils, name)
+            else:
+                _m = patch.object(openstack_utils, name, new)
+            setattr(self, name, _m.start())
+            self.addCleanup(_m.stop)
+        self.unitdata.kv.return_value = self.db
+        self.config.return_value = None
+        self.git_os_codename_install_source.return_value = None
+        self.get_os_codename_package.side_effect = \
+            lambda package, fatal: self.packages[package]
+        self.addCleanup(setattr, openstack_utils, '_os_rel', None)
+
+    def _os_release(self, package):
+        # Each call stands for a new hook, with an empty in-memory cache.
+        openstack_utils._os_rel = None
+        return openstack_utils.os_release(package)
+
+    def test_os_release_cached_per_package(self):
+        self.assertEqual(self._os_release('neutron-common'), 'ocata')
+        self.assertEqual(self._os_release('nova-common'), 'newton')
+        self.assertEqual(self.get_os_codename_package.call_count, 2)
+        self.get_os_codename_package.reset_mock()
+        with patch.object(self.db, 'set') as _set:
+            self.assertEqual(self._os_release('neutron-common'), 'ocata')
+            self.assertEqual(self._os_release('nova-common'), 'newton')
+            self.assertFalse(_set.called)
+        self.assertFalse(self.get_os_codename_package.called)
+
+    def test_reset_os_release(self):
+        self._os_release('neutron-common')
+        self._os_release('nova-common')
+        openstack_utils.reset_os_release()
+        self.assertEqual(
+            self.db.getrange('%s.' % openstack_utils.OS_RELEASE_KEY), {})
+        self.get_os_codename_package.reset_mock()
+        self._os_release('neutron-common')
+        self.assertTrue(self.get_os_codename_package.called)
+
+
+class CountingContext(object):
+
+    interfaces = ['counting']
+    evaluations = []
+
+    def __init__(self, name='count'):
+        self.name = name
+
+    def __call__(self):
+        self.evaluations.append(self.name)
+        self.related = True
+        return {self.name: len(self.evaluations)}
+
+
+class TemplatingContextCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(TemplatingContextCacheTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        templates = os.path.join(tmpdir, 'templates')
+        os.mkdir(templates)
+        self.out = os.path.join(tmpdir, 'out')
+        os.mkdir(self.out)
+        for name in ('a.conf', 'b.conf'):
+            with open(os.path.join(templates, name), 'w') as f:
+                f.write('{{ count }} {{ other }}\n')
+        for method in ('log', 'get_bytecode_cache'):
+            _m = patch.object(templating, method)
+            _m.start()
+            self.addCleanup(_m.stop)
+        templating.get_bytecode_cache.return_value = None
+        _m = patch.object(CountingContext, 'evaluations', [])
+        self.evaluations = _m.start()
+        self.addCleanup(_m.stop)
+        self.renderer = OSConfigRenderer(templates, 'ocata')
+        self.a = os.path.join(self.out, 'a.conf')
+        self.b = os.path.join(self.out, 'b.conf')
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_equivalent_contexts_shared(self):
+        a_ctxt = CountingContext()
+        b_ctxt = CountingContext()
+        self.renderer.register(self.a, [a_ctxt])
+        self.renderer.register(self.b, [b_ctxt])
+        self.renderer.write_all()
+        self.assertEqual(self.evaluations, ['count'])
+        self.assertEqual(self._read(self.a), self._read(self.b))
+        # Attributes set while evaluating are carried over.
+        self.assertTrue(b_ctxt.related)
+
+    def test_distinct_contexts_not_shared(self):
+        def other_context():
+            self.evaluations.append('function')
+            return {'other': 'x'}
+
+        other_context.interfaces = []
+        self.renderer.register(self.a, [CountingContext(), other_context])
+        self.renderer.register(self.b, [CountingContext('other'),
+                                        other_context])
+        self.renderer.write_all()
+        self.assertEqual(sorted(self.evaluations),
+                         ['count', 'function', 'function', 'other'])
+
+    def test_cache_not_kept_between_calls(self):
+        self.renderer.register(self.a, [CountingContext()])
+        self.renderer.register(self.b, [CountingContext()])
+        self.renderer.write_all()
+        self.renderer.write_all()
+        self.assertEqual(len(self.evaluations), 2)
+        self.renderer.write(self.a)
+        self.renderer.write(self.b)
+        self.assertEqual(len(self.evaluations), 4)
+        # Rendered one at a time, each write sees fresh results.
+        self.assertEqual(self._read(self.a), '3 ')
+        self.assertEqual(self._read(self.b), '4 ')
+        self.assertIsNone(self.renderer._context_cache)
+
+    def test_complete_contexts_shared(self):
+        self.renderer.register(self.a, [CountingContext()])
+        self.renderer.register(self.b, [CountingContext()])
+        self.assertEqual(self.renderer.complete_contexts(),
+                         ['counting', 'counting'])
+        self.assertEqual(len(self.evaluations), 1)
+
+
+class RendererWriteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(RendererWriteTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        templates = os.path.join(tmpdir, 'templates')
+        os.mkdir(templates)
+        with open(os.path.join(templates, 'neutron.conf'), 'w') as f:
+            f.write('debug = {{ debug }}')
+        for method in ('log', 'get_bytecode_cache'):
+            _m = patch.object(templating, method)
+            _m.start()
+            self.addCleanup(_m.stop)
+        templating.get_bytecode_cache.return_value = None
+        for method in ('log', 'service'):
+            _m = patch.object(host, method)
+            setattr(self, method, _m.start())
+            self.addCleanup(_m.stop)
+        self.target = os.path.join(tmpdir, 'neutron.conf')
+        self.addCleanup(host._journalled_paths.discard, self.target)
+        self.debug = {'debug': False}
+        self.renderer = OSConfigRenderer(templates, 'ocata')
+        self.renderer.register(self.target, [self._context])
+
+    def _context(self):
+        return dict(self.debug)
+
+    _context.interfaces = []
+
+    def _write(self):
+        return host.restart_on_change_helper(
+            lambda: self.renderer.write(self.target),
+            {self.target: ['neutron-server']})
+
+    def test_write_unchanged(self):
+        with open(self.target, 'w') as f:
+            f.write('debug = False')
+        os.utime(self.target, (0, 0))
+        self.assertFalse(self._write())
+        self.assertEqual(os.stat(self.target).st_mtime, 0)
+        self.assertFalse(self.service.called)
+
+    def test_write_changed(self):
+        self.assertIn(self.target, host._journalled_paths)
+        self.assertTrue(self._write())
+        with open(self.target) as f:
+            self.assertEqual(f.read(), 'debug = False')
+        self.service.assert_called_once_with('restart', 'neutron-server')
+        self.service.reset_mock()
+        self.debug['debug'] = True
+        self.assertTrue(self._write())
+        self.service.assert_called_once_with('restart', 'neutron-server')
+
+    def test_path_changed_reported(self):
+        changes = set()
+        host._path_changes.append(changes)
+        try:
+            self.renderer.write(self.target)
+            self.assertEqual(changes, set([self.target]))
+            changes.clear()
+            self.renderer.write(self.target)
+            self.assertEqual(changes, set())
+        finally:
+            host._path_changes.remove(changes)
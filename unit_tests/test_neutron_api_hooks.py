@@ -19,6 +19,8 @@ import yaml
 from mock import MagicMock, patch, call
 from test_utils import CharmTestCase
 
+import charmhelpers.core.hookenv as hookenv
+
 # python-apt is not installed as part of test-requirements but is imported by
 # some charmhelpers modules so create a fake import.
 sys.modules['apt'] = MagicMock()
@@ -46,20 +48,25 @@ utils.restart_map = _map
 TO_PATCH = [
     'api_port',
     'apt_update',
+    'buffer_log',
     'apt_install',
     'config',
     'CONFIGS',
     'check_call',
     'add_source',
     'configure_installation_source',
+    'compact_unit_state',
     'determine_packages',
     'determine_ports',
     'do_openstack_upgrade',
     'dvr_router_present',
     'local_unit',
     'l3ha_router_present',
+    'load_relation_snapshot',
     'execd_preinstall',
     'filter_installed_packages',
+    'package_plan_changed',
+    'record_package_plan',
     'get_dns_domain',
     'get_dvr',
     'get_l3ha',
@@ -72,6 +79,11 @@ TO_PATCH = [
     'migrate_neutron_database',
     'neutron_ready',
     'open_port',
+    'queue_relation_set',
+    'atexit',
+    'gate_api_ready',
+    'queue_restarts',
+    'defer_commits',
     'openstack_upgrade_available',
     'os_release',
     'os_requires_version',
@@ -85,6 +97,7 @@ TO_PATCH = [
     'get_netmask_for_address',
     'update_nrpe_config',
     'service_reload',
+    'set_log_level',
     'neutron_plugin_attribute',
     'IdentityServiceContext',
     'force_etcd_restart',
@@ -218,6 +231,7 @@ class NeutronAPIHooksTests(CharmTestCase):
         ])
         self.git_install.assert_called_with(projects_yaml)
         self.open_port.assert_has_calls(_port_calls)
+        self.assertTrue(self.CONFIGS.compile_templates.called)
 
     @patch.object(hooks, 'configure_https')
     @patch.object(hooks, 'git_install_requested')
@@ -246,6 +260,20 @@ class NeutronAPIHooksTests(CharmTestCase):
         self.assertTrue(self.do_openstack_upgrade.called)
         self.assertTrue(self.apt_install.called)
 
+    @patch.object(hooks, 'additional_install_locations')
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'git_install_requested')
+    def test_config_changed_package_plan_unchanged(self, git_requested,
+                                                   conf_https, add_locs):
+        git_requested.return_value = False
+        self.neutron_ready.return_value = False
+        self.openstack_upgrade_available.return_value = False
+        self.package_plan_changed.return_value = False
+        self._call_hook('config-changed')
+        self.assertFalse(self.apt_install.called)
+        self.assertFalse(self.record_package_plan.called)
+        self.assertTrue(self.CONFIGS.write_all.called)
+
     def test_config_changed_nodvr_disprouters(self):
         self.neutron_ready.return_value = True
         self.dvr_router_present.return_value = True
@@ -308,6 +336,7 @@ class NeutronAPIHooksTests(CharmTestCase):
         self.assertTrue(self.apt_install.called)
         self.assertTrue(configure_https.called)
         self.assertTrue(self.update_nrpe_config.called)
+        self.assertTrue(self.CONFIGS.compile_templates.called)
         self.assertTrue(self.CONFIGS.write_all.called)
         self.assertTrue(_n_api_rel_joined.called)
         self.assertTrue(_n_plugin_api_rel_joined.called)
@@ -326,6 +355,10 @@ class NeutronAPIHooksTests(CharmTestCase):
 
         self.assertFalse(self.do_openstack_upgrade.called)
 
+    def test_update_status_compacts_unit_state(self):
+        self._call_hook('update-status')
+        self.compact_unit_state.assert_called_once_with()
+
     def test_amqp_joined(self):
         self._call_hook('amqp-relation-joined')
         self.relation_set.assert_called_with(
@@ -523,6 +556,7 @@ class NeutronAPIHooksTests(CharmTestCase):
             **_relation_data
         )
         self.assertTrue(_id_rel_joined.called)
+        self.assertFalse(self.gate_api_ready.called)
         self.test_config.set('neutron-security-groups', True)
         self._call_hook('neutron-api-relation-joined')
         _relation_data['neutron-security-groups'] = 'yes'
@@ -554,6 +588,7 @@ class NeutronAPIHooksTests(CharmTestCase):
             relation_id=None,
             **_relation_data
         )
+        self.assertTrue(self.gate_api_ready.called)
 
     def test_vsd_api_relation_changed(self):
         self.os_release.return_value = 'kilo'
@@ -787,6 +822,15 @@ class NeutronAPIHooksTests(CharmTestCase):
         self._call_hook('cluster-relation-changed')
         self.assertTrue(self.CONFIGS.write_all.called)
 
+    @patch('charmhelpers.contrib.openstack.utils.is_unit_paused_set')
+    def test_restart_map_evaluated_lazily(self, is_unit_paused_set):
+        is_unit_paused_set.return_value = False
+        # restart_map is passed uncalled to the restart_on_change
+        # decorators and only resolved when a wrapped handler runs
+        hooks.restart_map.reset_mock()
+        hooks.cluster_changed()
+        hooks.restart_map.assert_called_once_with()
+
     @patch.object(hooks, 'get_hacluster_config')
     def test_ha_joined(self, _get_ha_config):
         _ha_config = {
@@ -1001,3 +1045,55 @@ class NeutronAPIHooksTests(CharmTestCase):
         self.assertTrue(self.CONFIGS.register.called)
         self.CONFIGS.write.assert_any_call('/etc/init/etcd.conf')
         self.CONFIGS.write.assert_any_call('/etc/default/etcd')
+
+    @patch.object(hooks, 'assess_status')
+    @patch.object(hooks.hooks, 'execute')
+    def test_main_loads_relation_snapshot(self, execute, assess_status):
+        calls = []
+        self.load_relation_snapshot.side_effect = \
+            lambda: calls.append('snapshot')
+        self.queue_relation_set.side_effect = \
+            lambda: calls.append('queue')
+        self.atexit.side_effect = lambda f: calls.append(f.__name__)
+        self.queue_restarts.side_effect = \
+            lambda order: calls.append('restarts')
+        self.defer_commits.side_effect = lambda: calls.append('defer')
+        execute.side_effect = lambda args: calls.append('execute')
+        hooks.main()
+        # atexit callbacks run in reverse, so the readiness gate waits for
+        # queued restarts and relation data is only published after it
+        self.assertEqual(calls, ['snapshot', 'queue', 'api_ready_gate',
+                                 'restarts', 'defer', 'execute'])
+        self.queue_restarts.assert_called_with(order=hooks.RESTART_ORDER)
+        assess_status.assert_called_with(self.CONFIGS)
+
+    @patch('charmhelpers.core.hookenv._py_atexit')
+    @patch('charmhelpers.core.hookenv.subprocess')
+    @patch.object(hooks, 'assess_status')
+    def test_main_juju_log_forks(self, assess_status, _subprocess,
+                                 _py_atexit):
+        # Count juju-log forks for a hook which logs like a write_all() over
+        # eight configs: one fork with buffering, none for DEBUG.
+        self.buffer_log.side_effect = hookenv.buffer_log
+        self.set_log_level.side_effect = hookenv.set_log_level
+        self.addCleanup(hookenv.set_log_level, None)
+        self.addCleanup(setattr, hookenv, '_log_buffer', None)
+
+        def bench_hook():
+            for i in range(8):
+                hookenv.log('Registered config file: %d' % i, level='INFO')
+                hookenv.log('Loaded template for %d' % i, level='INFO')
+                hookenv.log('Rendering from template: %d' % i, level='INFO')
+                hookenv.log('Wrote template %d.' % i, level='INFO')
+                hookenv.log('Context for %d' % i, level='DEBUG')
+
+        hooks.hooks.register('bench-hook', bench_hook)
+        self.addCleanup(hooks.hooks._hooks.pop, 'bench-hook')
+        with patch.object(sys, 'argv', ['hooks/bench-hook']):
+            hooks.main()
+        forks = [c for c in _subprocess.call.call_args_list
+                 if c[0][0][0] == 'juju-log']
+        self.assertEqual(len(forks), 1)
+        self.assertEqual(forks[0][0][0][:3], ['juju-log', '-l', 'INFO'])
+        self.assertEqual(len(forks[0][0][0][3].split('\n')), 32)
+        self.assertTrue(_py_atexit.register.called)
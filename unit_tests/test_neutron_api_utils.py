@@ -225,6 +225,45 @@ class TestNeutronAPIUtils(CharmTestCase):
                 found_sdnconfig_ctxt = True
         self.assertTrue(found_sdn_ctxt and found_sdnconfig_ctxt)
 
+    @patch.object(nutils, 'deepcopy')
+    @patch.object(nutils, 'manage_plugin')
+    @patch('os.path.exists')
+    def test_resource_map_memoized(self, _path_exists, _manage_plugin,
+                                   _deepcopy):
+        _deepcopy.side_effect = deepcopy
+        self.os_release.return_value = 'havana'
+        _path_exists.return_value = False
+        _manage_plugin.return_value = True
+        _map = nutils.resource_map()
+        self.assertEqual(nutils.resource_map(), _map)
+        self.assertEqual(_deepcopy.call_count, 1)
+        # views share context instances but not containers
+        self.assertFalse(_map is nutils.resource_map())
+        _map[nutils.NEUTRON_CONF]['contexts'].append('bogus')
+        self.assertFalse('bogus' in
+                         nutils.resource_map()[nutils.NEUTRON_CONF]
+                         ['contexts'])
+        self.assertEqual(_deepcopy.call_count, 1)
+
+    @patch.object(nutils, 'deepcopy')
+    @patch.object(nutils, 'manage_plugin')
+    @patch('os.path.exists')
+    def test_resource_map_memoized_key_change(self, _path_exists,
+                                              _manage_plugin, _deepcopy):
+        _deepcopy.side_effect = deepcopy
+        self.os_release.return_value = 'havana'
+        _path_exists.return_value = False
+        _manage_plugin.return_value = True
+        nutils.resource_map()
+        self.os_release.return_value = 'liberty'
+        _map = nutils.resource_map()
+        self.assertEqual(_deepcopy.call_count, 2)
+        self.assertIn(nutils.NEUTRON_LBAAS_CONF, _map)
+        _path_exists.return_value = True
+        _map = nutils.resource_map()
+        self.assertEqual(_deepcopy.call_count, 3)
+        self.assertIn(nutils.APACHE_24_CONF, _map)
+
     @patch('os.path.exists')
     def test_restart_map(self, mock_path_exists):
         self.os_release.return_value = 'havana'
@@ -253,6 +292,45 @@ class TestNeutronAPIUtils(CharmTestCase):
         ])
         self.assertItemsEqual(_restart_map, expect)
 
+    @patch.object(charmhelpers.contrib.openstack.utils,
+                  'get_installed_version')
+    @patch.object(charmhelpers.contrib.openstack.utils,
+                  'snap_install_requested')
+    def test_os_codename_package_pre_liberty(self, snap_install_requested,
+                                             get_installed_version):
+        snap_install_requested.return_value = False
+        get_os_codename_package = \
+            charmhelpers.contrib.openstack.utils.get_os_codename_package
+        get_installed_version.return_value = '1:2015.1.2-0ubuntu2'
+        self.assertEqual(get_os_codename_package('neutron-common',
+                                                 fatal=False), 'kilo')
+        get_installed_version.return_value = '1:2014.1.5-0ubuntu1'
+        self.assertEqual(get_os_codename_package('neutron-common'),
+                         'icehouse')
+        get_installed_version.return_value = '1:2012.1-0ubuntu1'
+        self.assertEqual(get_os_codename_package('neutron-common',
+                                                 fatal=False), 'essex')
+        get_installed_version.return_value = '2.2.0-0ubuntu1'
+        self.assertEqual(get_os_codename_package('swift-proxy',
+                                                 fatal=False), 'juno')
+
+    def test_lazy_configs(self):
+        factory = MagicMock()
+        configs = nutils.LazyConfigs(factory)
+        self.assertFalse(factory.called)
+        configs.write_all()
+        configs.complete_contexts()
+        factory.assert_called_once_with()
+        self.assertTrue(factory.return_value.write_all.called)
+        self.assertTrue(factory.return_value.complete_contexts.called)
+
+    @patch.object(nutils, 'service_reload')
+    def test_restart_functions(self, service_reload):
+        _restart_functions = nutils.restart_functions()
+        self.assertEqual(sorted(_restart_functions), ['apache2', 'haproxy'])
+        _restart_functions['haproxy']('haproxy')
+        service_reload.assert_called_with('haproxy', restart_on_failure=True)
+
     @patch('os.path.exists')
     def test_register_configs(self, mock_path_exists):
         self.os_release.return_value = 'havana'
@@ -658,6 +736,112 @@ class TestNeutronAPIUtils(CharmTestCase):
         nutils.additional_install_locations('Calico', '')
         self.add_source.assert_called_with('ppa:project-calico/calico-1.4')
 
+    @patch.object(nutils, 'unitdata')
+    def test_compact_unit_state(self, unitdata):
+        db = unitdata.kv.return_value
+        db.prune.return_value = 12
+        nutils.compact_unit_state()
+        db.prune.assert_called_with(revisions=100, days=30)
+        self.assertTrue(db.compact.called)
+
+    @patch.object(nutils, 'unitdata')
+    @patch.object(nutils, 'determine_api_port')
+    @patch.object(nutils, 'wait_for_listeners')
+    @patch.object(nutils, '_api_responding')
+    def test_wait_for_api_ready(self, _api_responding, wait_for_listeners,
+                                determine_api_port, unitdata):
+        self.test_config.set('prefer-ipv6', False)
+        determine_api_port.return_value = 9686
+        wait_for_listeners.return_value = True
+        _api_responding.return_value = True
+        self.assertTrue(nutils.wait_for_api_ready())
+        wait_for_listeners.assert_called_with(
+            '127.0.0.1', [9696, 9686], timeout=nutils.API_READY_TIMEOUT,
+            interval=nutils.API_READY_INITIAL_DELAY, backoff=2,
+            max_interval=nutils.API_READY_MAX_DELAY)
+        _api_responding.assert_called_with('127.0.0.1', 9686)
+        db = unitdata.kv.return_value
+        key, timing = db.set.call_args[0]
+        self.assertEqual(key, nutils.API_READY_KEY)
+        self.assertTrue(timing['ready'])
+        self.assertTrue(db.flush.called)
+
+        wait_for_listeners.return_value = False
+        _api_responding.reset_mock()
+        self.assertFalse(nutils.wait_for_api_ready())
+        self.assertFalse(_api_responding.called)
+
+    @patch.object(nutils, 'unitdata')
+    @patch.object(nutils, 'determine_api_port')
+    @patch.object(nutils, 'wait_for_listeners')
+    @patch.object(nutils, '_api_responding')
+    @patch.object(nutils.time, 'sleep')
+    @patch.object(nutils.time, 'time')
+    def test_wait_for_api_ready_polls_http(self, _time, sleep,
+                                           _api_responding,
+                                           wait_for_listeners,
+                                           determine_api_port, unitdata):
+        clock = [0.0]
+        _time.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda s: clock.__setitem__(0, clock[0] + s)
+        self.test_config.set('prefer-ipv6', False)
+        determine_api_port.return_value = 9686
+        wait_for_listeners.return_value = True
+        _api_responding.side_effect = [False, False, False, True]
+        self.assertTrue(nutils.wait_for_api_ready())
+        self.assertEqual(_api_responding.call_count, 4)
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual(delays, [nutils.API_READY_INITIAL_DELAY,
+                                  nutils.API_READY_INITIAL_DELAY * 2,
+                                  nutils.API_READY_INITIAL_DELAY * 4])
+
+        # Never answering: give up once the timeout has passed.
+        clock[0] = 0.0
+        sleep.reset_mock()
+        _api_responding.side_effect = None
+        _api_responding.return_value = False
+        self.assertFalse(nutils.wait_for_api_ready(timeout=10))
+        self.assertEqual(clock[0], 10)
+        self.assertTrue(all(c[0][0] <= nutils.API_READY_MAX_DELAY
+                            for c in sleep.call_args_list))
+        db = unitdata.kv.return_value
+        self.assertFalse(db.set.call_args[0][1]['ready'])
+
+    @patch.object(nutils, 'wait_for_api_ready')
+    @patch.object(nutils, 'is_unit_paused_set')
+    def test_api_ready_gate(self, is_unit_paused_set, wait_for_api_ready):
+        is_unit_paused_set.return_value = False
+        nutils.api_ready_gate()
+        self.assertFalse(wait_for_api_ready.called)
+        nutils.gate_api_ready()
+        nutils.gate_api_ready()
+        nutils.api_ready_gate()
+        nutils.api_ready_gate()
+        wait_for_api_ready.assert_called_once_with()
+
+    @patch.object(nutils, 'get_installed_version')
+    @patch.object(nutils, 'path_hash')
+    @patch.object(nutils, 'unitdata')
+    def test_package_plan_changed(self, unitdata, path_hash, installed):
+        path_hash.side_effect = lambda p: {p: 'abc'}
+        installed.return_value = '1.0'
+        db = unitdata.kv.return_value
+        db.get.return_value = None
+        self.assertTrue(nutils.package_plan_changed(['haproxy']))
+        nutils.record_package_plan(['haproxy'])
+        plan = db.set.call_args[0][1]
+        self.assertEqual(plan['packages'], {'haproxy': '1.0'})
+        self.assertEqual(len(plan['sources']), len(nutils.APT_STATE_PATHS))
+        self.assertTrue(db.flush.called)
+        db.get.return_value = plan
+        self.assertFalse(nutils.package_plan_changed(['haproxy']))
+        self.assertFalse(nutils.package_plan_changed())
+        installed.return_value = None
+        self.assertTrue(nutils.package_plan_changed(['haproxy']))
+        self.assertFalse(nutils.package_plan_changed())
+        path_hash.side_effect = lambda p: {p: 'def'}
+        self.assertTrue(nutils.package_plan_changed())
+
     @patch('shutil.rmtree')
     def test_force_etcd_restart(self, rmtree):
         self.glob.glob.return_value = [